@@ -0,0 +1,80 @@
+"""
+Serialization Benchmark
+
+Compares the rows/sec of building a list response through full ORM
+Product objects and jsonify() against the row tuple fast path used by
+GET /products.
+
+Run it with:
+  python -m benchmarks.serialization --rows 50000
+"""
+import os
+import time
+import argparse
+
+# use a throwaway database unless one is given
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+from flask import jsonify  # noqa: E402
+from service import app, fastjson  # noqa: E402
+from service.models import db, Product  # noqa: E402
+from tests.factories import ProductFactory  # noqa: E402
+
+
+def seed(count: int):
+    """Loads the database with fake Products"""
+    db.drop_all()
+    db.create_all()
+    items = [ProductFactory().serialize() for _ in range(count)]
+    Product.bulk_create(items)
+    db.session.remove()
+
+
+def orm_path() -> int:
+    """Hydrates every row into a Product and serializes it with jsonify"""
+    products = Product.query.all()
+    body = jsonify([product.serialize() for product in products]).get_data()
+    db.session.remove()
+    return len(body)
+
+
+def fast_path() -> int:
+    """Loads plain row tuples and encodes them straight to JSON bytes"""
+    fields = list(Product.FIELDS)
+    rows = Product.select_fields(fields).all()
+    body = fastjson.dumps([Product.serialize_fields(row, fields) for row in rows])
+    db.session.remove()
+    return len(body)
+
+
+def measure(func, rows: int, repeat: int) -> float:
+    """Returns the best rows/sec of a few runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def main():
+    """Runs the benchmark and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000, help="number of products")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per path")
+    args = parser.parse_args()
+
+    with app.test_request_context():
+        seed(args.rows)
+        orm = measure(orm_path, args.rows, args.repeat)
+        fast = measure(fast_path, args.rows, args.repeat)
+
+    print("rows: {}  encoder: {}".format(args.rows, fastjson.encoder_name()))
+    print("{:<10} {:>12,.0f} rows/sec".format("orm", orm))
+    print("{:<10} {:>12,.0f} rows/sec".format("fast", fast))
+    print("speedup    {:>12.2f}x".format(fast / orm))
+
+
+if __name__ == "__main__":
+    main()
@@ -19,5 +19,94 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool sizing and health checks
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("true", "yes", "1")
+
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": DB_POOL_PRE_PING}
+# SQLite uses a static or null pool that cannot be sized
+if not DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+    )
+
+# Read replicas for the read-only Product queries (comma separated URIs),
+# how often each is health checked, and how long a client that wrote keeps
+# reading from the primary
+REPLICA_DATABASE_URIS = [uri for uri in os.getenv("REPLICA_DATABASE_URIS", "").split(",") if uri]
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "10"))
+REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+# Largest page of Products that can be requested with ?limit=
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Page size of ?q= search results when no limit is given
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+
+# Page size of GET /products/changes when no limit is given
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "100"))
+
+# Upper bounds of the price histogram buckets of GET /products/facets, and
+# how long a worker trusts its facet summary before reloading it
+FACET_PRICE_BUCKETS = [
+    float(bound) for bound in os.getenv("FACET_PRICE_BUCKETS", "10,50,100,500,1000,5000").split(",")
+]
+FACET_TTL = float(os.getenv("FACET_TTL", "60"))
+
+# Response compression: bodies below COMPRESSION_MIN_SIZE bytes are sent
+# as they are, and up to COMPRESSION_CACHE_BYTES of compressed bodies with
+# an ETag are kept to be sent again
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("true", "yes", "1")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_CACHE_BYTES = int(os.getenv("COMPRESSION_CACHE_BYTES", str(16 * 1024 * 1024)))
+
+# Server-Sent Events at GET /products/events: events buffered per client
+# before it gets a reset, events kept to replay after a reconnect, the most
+# open streams per worker and the seconds between keep-alive comments.
+# A gthread stream holds one of the GUNICORN_THREADS of its worker for as
+# long as it is open, so by default one thread is always left for the
+# other requests; under gevent a stream only holds a greenlet.
+EVENTS_BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", "1000"))
+EVENTS_HISTORY_SIZE = int(os.getenv("EVENTS_HISTORY_SIZE", "1000"))
+if os.getenv("GUNICORN_WORKER_CLASS", "gthread") == "gevent":
+    EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "100"))
+else:
+    EVENTS_MAX_SUBSCRIBERS = int(
+        os.getenv("EVENTS_MAX_SUBSCRIBERS", str(max(int(os.getenv("GUNICORN_THREADS", "4")) - 1, 0)))
+    )
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))
+
+# Number of rows fetched per round-trip when streaming full exports
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+# Largest list of Products accepted by the batch endpoints
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100000"))
+
+# Read-through cache for single Product lookups. Each process has its own,
+# so gunicorn.conf.py turns it off by default when there are several workers
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("true", "yes", "1")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+
+# Opt-in write coalescing for PUT /products/{id}: updates are answered with
+# 202 Accepted and written in batches of up to WRITE_BEHIND_MAX_ITEMS, at
+# most WRITE_BEHIND_MAX_DELAY seconds after they arrive
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() in ("true", "yes", "1")
+WRITE_BEHIND_MAX_ITEMS = int(os.getenv("WRITE_BEHIND_MAX_ITEMS", "500"))
+WRITE_BEHIND_MAX_DELAY = float(os.getenv("WRITE_BEHIND_MAX_DELAY", "1.0"))
+
+# Opt-in N+1 and slow query detector for development and tests
+QUERY_DETECTOR_ENABLED = os.getenv("QUERY_DETECTOR_ENABLED", "false").lower() in ("true", "yes", "1")
+QUERY_DETECTOR_RAISE = os.getenv("QUERY_DETECTOR_RAISE", "false").lower() in ("true", "yes", "1")
+QUERY_DETECTOR_MAX_STATEMENTS = int(os.getenv("QUERY_DETECTOR_MAX_STATEMENTS", "10"))
+QUERY_DETECTOR_SLOW_MS = float(os.getenv("QUERY_DETECTOR_SLOW_MS", "100"))
+QUERY_DETECTOR_REPEAT = int(os.getenv("QUERY_DETECTOR_REPEAT", "3"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
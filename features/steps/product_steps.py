@@ -34,22 +34,20 @@ from selenium.webdriver.support import expected_conditions
 def step_impl(context):
     """ Delete all products and load new ones """
     headers = {'Content-Type': 'application/json'}
-    # list all of the products and delete them one by one
-    context.resp = requests.get(context.base_url + '/products', headers=headers)
-    expect(context.resp.status_code).to_equal(200)
-    for product in context.resp.json():
-        context.resp = requests.delete(context.base_url + '/products/' + str(product["id"]), headers=headers)
-        expect(context.resp.status_code).to_equal(204)
-    
-    # load the database with new products
-    create_url = context.base_url + '/products'
+    # delete all of the products in one request
+    context.resp = requests.delete(context.base_url + '/products?all=true', headers=headers)
+    expect(context.resp.status_code).to_equal(204)
+
+    # load the database with new products in one batch
+    create_url = context.base_url + '/products:batch'
+    products = []
     for row in context.table:
-        data = {
+        products.append({
             "name": row['name'],
             "category": row['category'],
             "available": row['available'] in ['True', 'true', '1'],
             "price": row['price']
-        }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+        })
+    payload = json.dumps(products)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(201)
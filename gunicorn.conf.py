@@ -0,0 +1,82 @@
+"""
+Gunicorn configuration for production
+
+Every setting can be overridden with an environment variable so the same
+file works on a laptop and in Cloud Foundry. Keep workers * threads at or
+below DB_POOL_SIZE + DB_MAX_OVERFLOW so requests do not queue on the pool
+(see GET /internal/pool).
+
+The product cache lives in each worker and only sees the writes of its
+own worker, so it is off by default when there is more than one worker;
+set CACHE_ENABLED=true to trade up to CACHE_TTL seconds of staleness for
+the faster reads.
+"""
+import os
+import multiprocessing
+
+bind = "0.0.0.0:" + os.getenv("PORT", "8080")
+
+# gthread runs several requests per worker so one slow query does not
+# block the process; gevent is also supported (pip install gevent psycogreen)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2 + 1)))
+if workers > 1:
+    # read by config.py, which the master (preload) or the workers import later
+    os.environ.setdefault("CACHE_ENABLED", "false")
+# every open stream of GET /products/events holds a thread, so gthread
+# workers accept at most threads - 1 of them (EVENTS_MAX_SUBSCRIBERS)
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Load the app once in the master so workers start fast and share memory
+# copy-on-write. gevent must patch the standard library before the app is
+# imported, so it always loads the app in each worker instead.
+preload_app = worker_class != "gevent" and (
+    os.getenv("GUNICORN_PRELOAD", "true").lower() in ("true", "yes", "1")
+)
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# Recycle workers now and then to bound memory growth
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "10000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "1000"))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def pre_fork(server, worker):  # pylint: disable=unused-argument
+    """Closes the master's database connections before forking"""
+    if preload_app:
+        from service.models import db  # pylint: disable=import-outside-toplevel
+
+        db.engine.dispose()
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Gives each worker its own connection pool"""
+    if worker_class == "gevent":
+        try:
+            from psycogreen.gevent import patch_psycopg  # pylint: disable=import-outside-toplevel
+
+            patch_psycopg()
+        except ImportError:
+            server.log.warning("psycogreen is not installed: database calls will block gevent")
+    if preload_app:
+        from service.models import db  # pylint: disable=import-outside-toplevel
+
+        # never share a socket inherited from the master
+        db.engine.dispose()
+        server.log.info("Worker %s disposed the inherited connection pool", worker.pid)
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """Writes the updates still in the write-behind queue of a worker"""
+    from service.write_behind import write_behind  # pylint: disable=import-outside-toplevel
+
+    flushed = write_behind.flush()
+    if flushed:
+        server.log.info("Worker %s flushed %d queued updates", worker.pid, flushed)
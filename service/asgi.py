@@ -0,0 +1,320 @@
+"""
+ASGI entry point
+
+An asyncio variant of the /products API, so a single process can serve
+thousands of concurrent slow clients without pinning a worker per
+request. It reuses the Product model, its validation and the error
+format of the Flask service, but talks to the database through an async
+SQLAlchemy engine (asyncpg for PostgreSQL, aiosqlite for SQLite).
+
+Run it with any ASGI server, e.g.:
+  pip install uvicorn asyncpg aiosqlite
+  uvicorn service.asgi:app --port 8080
+
+Paths:
+------
+GET /products - Returns the Products matching the filters (sort, limit/cursor pages)
+GET /products/{id} - Returns the Product with a given id number
+POST /products - creates a new Product record in the database
+PUT /products/{id} - updates a Product record in the database
+DELETE /products/{id} - deletes a Product record in the database
+PUT /products/{id}/disable - Disable a product
+PUT /products/{id}/enable - Enable of a product
+"""
+import re
+import json
+import logging
+from urllib.parse import parse_qs, urlencode
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from service import app as flask_app, status, fastjson
+from service.models import Product, DataValidationError, db
+from service.cache import product_cache
+from service.routes import parse_bool, parse_limit, parse_price, check_price_range
+
+logger = logging.getLogger("flask.app")
+
+# Async drivers used for each database
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_database_uri(uri: str) -> str:
+    """Returns the database URI with its async driver"""
+    scheme, sep, rest = uri.partition("://")
+    return ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+class HTTPError(Exception):
+    """An error that is returned to the client with a status code"""
+
+    def __init__(self, status_code: int, error: str, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error = error
+        self.message = message
+
+
+def not_found(product_id):
+    """Returns the 404 error of a missing Product"""
+    return HTTPError(
+        status.HTTP_404_NOT_FOUND,
+        "Not Found",
+        "Product with id '{}' was not found.".format(product_id),
+    )
+
+
+class Request:
+    """The parts of an ASGI request the handlers need"""
+
+    def __init__(self, scope, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = {
+            key: values[0] for key, values in parse_qs(scope.get("query_string", b"").decode()).items()
+        }
+        self.headers = {
+            key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope.get("headers", [])
+        }
+        self.body = body
+
+    def get_json(self):
+        """Returns the JSON body, checking its Content-Type"""
+        if self.headers.get("content-type") != "application/json":
+            raise HTTPError(
+                status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                "Unsupported media type",
+                "Content-Type must be application/json",
+            )
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError as error:
+            raise DataValidationError("Invalid JSON: {}".format(error))
+
+
+class ProductService:
+    """ASGI application serving the /products API with async handlers"""
+
+    def __init__(self, database_uri: str = None, **engine_options):
+        self.database_uri = async_database_uri(
+            database_uri or flask_app.config["SQLALCHEMY_DATABASE_URI"]
+        )
+        self.engine_options = engine_options
+        self.engine = None
+        self.session_factory = None
+        self.routes = [
+            ("GET", re.compile(r"^/products$"), self.list_products),
+            ("POST", re.compile(r"^/products$"), self.create_products),
+            ("GET", re.compile(r"^/products/(\d+)$"), self.get_products),
+            ("PUT", re.compile(r"^/products/(\d+)$"), self.update_products),
+            ("DELETE", re.compile(r"^/products/(\d+)$"), self.delete_products),
+            ("PUT", re.compile(r"^/products/(\d+)/disable$"), self.disable_product),
+            ("PUT", re.compile(r"^/products/(\d+)/enable$"), self.enable_product),
+        ]
+
+    ##################################################################
+    # Lifecycle
+    ##################################################################
+    async def startup(self):
+        """Creates the async engine and the tables"""
+        logger.info("Starting the async product service")
+        self.engine = create_async_engine(self.database_uri, **self.engine_options)
+        self.session_factory = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False
+        )
+        async with self.engine.begin() as conn:
+            await conn.run_sync(db.Model.metadata.create_all)
+
+    async def shutdown(self):
+        """Closes every database connection"""
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    ##################################################################
+    # ASGI protocol
+    ##################################################################
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if self.engine is None:
+            await self.startup()
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        status_code, payload, headers = await self.dispatch(Request(scope, body))
+        raw_headers = [(b"content-type", b"application/json")]
+        raw_headers += [(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()]
+        content = b"" if payload is None else fastjson.dumps(payload)
+        raw_headers.append((b"content-length", str(len(content)).encode()))
+        await send({"type": "http.response.start", "status": status_code, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": content})
+
+    async def lifespan(self, receive, send):
+        """Handles the server startup and shutdown messages"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def dispatch(self, request: Request):
+        """Calls the handler of a request and turns errors into responses"""
+        allowed = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if not match:
+                continue
+            allowed = True
+            if method != request.method:
+                continue
+            try:
+                async with self.session_factory() as session:
+                    return await handler(session, request, *[int(arg) for arg in match.groups()])
+            except DataValidationError as error:
+                return self.error(status.HTTP_400_BAD_REQUEST, "Bad Request", str(error))
+            except IntegrityError as error:
+                return self.error(
+                    status.HTTP_409_CONFLICT, "Conflict", "Conflicting Product: {}".format(error.orig)
+                )
+            except HTTPError as error:
+                return self.error(error.status_code, error.error, error.message)
+        if allowed:
+            return self.error(
+                status.HTTP_405_METHOD_NOT_ALLOWED,
+                "Method not Allowed",
+                "The method is not allowed for the requested URL.",
+            )
+        return self.error(
+            status.HTTP_404_NOT_FOUND, "Not Found", "The requested URL was not found on the server."
+        )
+
+    @staticmethod
+    def error(status_code: int, error: str, message: str):
+        """Returns an error in the same format as the Flask error handlers"""
+        logger.warning(message)
+        return status_code, {"status": status_code, "error": error, "message": message}, {}
+
+    ##################################################################
+    # Handlers
+    ##################################################################
+    async def list_products(self, session, request):
+        """Returns the Products that match the filters in the query string"""
+        filters = {
+            "category": request.args.get("category") or None,
+            "name": request.args.get("name") or None,
+            "available": parse_bool(request.args.get("available")),
+            "minimum": parse_price(request.args.get("minimum"), "minimum"),
+            "maximum": parse_price(request.args.get("maximum"), "maximum"),
+        }
+        check_price_range(filters["minimum"], filters["maximum"])
+        sort = request.args.get("sort") or "id"
+        statement = select(Product).where(*Product.filter_clauses(**filters))
+        statement = statement.order_by(*Product.sort_order(sort))
+
+        headers = {}
+        limit = request.args.get("limit")
+        if limit is not None:
+            limit = parse_limit(limit)
+            cursor = request.args.get("cursor")
+            if cursor:
+                statement = statement.where(Product.after_cursor(cursor, sort))
+            statement = statement.limit(limit + 1)
+
+        products = list((await session.execute(statement)).scalars())
+        if limit is not None and len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            cursor = Product.encode_cursor(sort, getattr(last, sort.lstrip("-")), last.id)
+            query_string = urlencode(dict(request.args, cursor=cursor))
+            headers["link"] = '<{}?{}>; rel="next"'.format(request.path, query_string)
+        return status.HTTP_200_OK, [product.serialize() for product in products], headers
+
+    async def get_products(self, session, request, product_id):
+        """Returns a single Product"""
+        data = product_cache.get(product_id)
+        if data is None:
+            product = await session.get(Product, product_id)
+            if not product:
+                raise not_found(product_id)
+            data = product.serialize()
+            product_cache.set(product_id, data)
+        return status.HTTP_200_OK, data, {}
+
+    async def create_products(self, session, request):
+        """Creates a Product"""
+        product = Product().deserialize(request.get_json())
+        session.add(product)
+        await session.commit()
+        logger.info("Product with ID [%s] created.", product.id)
+        # expire_on_commit is off, so reload the values as they were stored
+        await session.refresh(product)
+        data = product.serialize()
+        Product.notify("create", data)
+        return status.HTTP_201_CREATED, data, {"location": "/products/{}".format(product.id)}
+
+    async def update_products(self, session, request, product_id):
+        """Updates a Product"""
+        data = request.get_json()
+        product = await session.get(Product, product_id)
+        if not product:
+            raise not_found(product_id)
+        before = product.serialize()
+        product.deserialize(data)
+        await session.commit()
+        await session.refresh(product)
+        data = product.serialize()
+        Product.notify("update", data, before)
+        return status.HTTP_200_OK, data, {}
+
+    async def delete_products(self, session, request, product_id):
+        """Deletes a Product"""
+        product = await session.get(Product, product_id)
+        if product:
+            data = product.serialize()
+            await session.delete(product)
+            await session.commit()
+            Product.notify("delete", data)
+        return status.HTTP_204_NO_CONTENT, None, {}
+
+    async def set_availability(self, session, request, product_id, available: bool):
+        """Enables or disables a Product"""
+        product = await session.get(Product, product_id)
+        if not product:
+            raise not_found(product_id)
+        before = product.serialize()
+        product.available = available
+        await session.commit()
+        await session.refresh(product)
+        data = product.serialize()
+        Product.notify("update", data, before)
+        return status.HTTP_200_OK, data, {}
+
+    async def disable_product(self, session, request, product_id):
+        """Updates a Product's availability to false"""
+        return await self.set_availability(session, request, product_id, False)
+
+    async def enable_product(self, session, request, product_id):
+        """Updates a Product's availability to true"""
+        return await self.set_availability(session, request, product_id, True)
+
+
+# The ASGI application, e.g. uvicorn service.asgi:app
+app = ProductService()
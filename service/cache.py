@@ -0,0 +1,156 @@
+"""
+Product Cache
+
+Read-through cache for serialized Products. The default backend is an
+in-process LRU with a time to live; any store that implements the
+CacheBackend interface (e.g. a Redis client wrapper) can be swapped in
+with set_backend().
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("flask.app")
+
+
+class CacheBackend:
+    """Interface that every cache backend implements"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the value for a key or None if it is not cached"""
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """Stores a value under a key"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes a key if it is cached"""
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes every key"""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Returns the counters used for monitoring"""
+        return {"backend": type(self).__name__, "hits": self.hits, "misses": self.misses}
+
+
+class NullCache(CacheBackend):
+    """A cache that never stores anything, used when caching is disabled"""
+
+    def get(self, key):
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """An in-process least recently used cache whose entries expire"""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0, clock=time.monotonic):
+        super().__init__()
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        data = super().stats()
+        data.update(size=len(self._entries), evictions=self.evictions)
+        return data
+
+
+class ProductCache:
+    """Holds the configured backend so it can be replaced at runtime"""
+
+    def __init__(self, backend: CacheBackend = None):
+        self.backend = backend or NullCache()
+
+    def set_backend(self, backend: CacheBackend):
+        """Replaces the cache backend"""
+        logger.info("Using %s for the product cache", type(backend).__name__)
+        self.backend = backend
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        return self.backend.stats()
+
+    def on_product_change(self, action: str, data: dict, before: dict = None):
+        """Product change listener that keeps the cache consistent"""
+        if action == "reset":
+            self.clear()
+        elif action in ("create", "update"):
+            # writing through also keeps a lagging read replica from
+            # refilling the entry with the old version
+            self.set(data["id"], data)
+        else:
+            self.delete(data["id"])
+
+
+# The cache shared by the whole service, configured in init_cache()
+product_cache = ProductCache()
+
+
+def init_cache(app):
+    """Configures the product cache from the Flask app config"""
+    if app.config.get("CACHE_ENABLED", True):
+        backend = LRUCache(app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_TTL"])
+    else:
+        backend = NullCache()
+    product_cache.set_backend(backend)
@@ -0,0 +1,221 @@
+"""
+Response Compression
+
+Compresses JSON and text responses with the best encoding the client
+accepts: zstd or Brotli when their packages are installed (pip install
+zstandard brotli), otherwise gzip. Bodies smaller than
+COMPRESSION_MIN_SIZE bytes are sent as they are, and so are Server-Sent
+Events, which must reach the client one event at a time.
+
+Streamed exports are compressed chunk by chunk as they are generated.
+Bodies with an ETag, such as the list responses, are kept compressed in
+a small LRU cache keyed on the ETag and encoding, so a popular page is
+compressed once instead of on every request. A compressed response keeps
+the ETag of its JSON as a weak ETag, which still matches If-None-Match
+and the If-Match of an update.
+"""
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+from flask import request
+from . import app, instrumentation
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+logger = logging.getLogger("flask.app")
+
+# Media types worth compressing; everything else (images, ...) is left alone
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript")
+
+# Compression levels that favor speed, since responses are compressed per request
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+def gzip_compressor():
+    """Returns a streaming gzip compressor"""
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def available_encodings() -> list:
+    """Returns the content codings this process can produce, best first"""
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+class StreamCompressor:
+    """Compresses a body chunk by chunk with one content coding"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._process = self._compressor.compress
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._process = self._compressor.process
+        else:
+            self._compressor = gzip_compressor()
+            self._process = self._compressor.compress
+
+    def compress(self, chunk: bytes) -> bytes:
+        """Returns the compressed bytes that are ready, possibly none"""
+        return self._process(chunk)
+
+    def finish(self) -> bytes:
+        """Returns the rest of the compressed body"""
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """Compresses a whole body"""
+    compressor = StreamCompressor(encoding)
+    return compressor.compress(body) + compressor.finish()
+
+
+def compress_stream(chunks, encoding: str, original=None):
+    """Yields a streamed body compressed, skipping the empty pieces
+
+    The compressor buffers small chunks (e.g. one NDJSON row each), so
+    the output comes in blocks instead of one tiny frame per row
+    """
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(original, "close"):
+            original.close()
+
+
+class CompressedBodyCache:
+    """LRU cache of compressed bodies keyed on (ETag, encoding)"""
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_bytes: int):
+        """Sets the most bytes kept, emptying the cache"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._entries.clear()
+            self.size = 0
+
+    def get(self, key):
+        """Returns a compressed body, or None"""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def set(self, key, body: bytes):
+        """Keeps a compressed body, evicting the least recently used ones"""
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# The compressed bodies of this process, configured in init_compression()
+compressed_bodies = CompressedBodyCache()
+
+
+def init_compression(app_):
+    """Configures the compressed body cache from the Flask app config"""
+    compressed_bodies.configure(app_.config["COMPRESSION_CACHE_BYTES"])
+
+
+def is_compressible(response) -> bool:
+    """Returns True for the responses that may be sent compressed"""
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if "Content-Encoding" in response.headers:
+        return False
+    mimetype = response.mimetype or ""
+    if mimetype == "text/event-stream":
+        return False
+    return mimetype in COMPRESSIBLE_TYPES or mimetype.startswith("text/")
+
+
+######################################################################
+# Flask request hooks
+######################################################################
+@app.after_request
+def compress_response(response):
+    """Compresses the response with the best encoding the client accepts"""
+    if not app.config.get("COMPRESSION_ENABLED") or not is_compressible(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        original = response.response
+        response.response = compress_stream(response.iter_encoded(), encoding, original)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < app.config["COMPRESSION_MIN_SIZE"]:
+            return response
+        etag, _ = response.get_etag()
+        key = (etag, encoding) if etag and request.method == "GET" else None
+        compressed = compressed_bodies.get(key) if key else None
+        if compressed is None:
+            with instrumentation.timer("compress"):
+                compressed = compress(body, encoding)
+            if key:
+                compressed_bodies.set(key, compressed)
+        response.set_data(compressed)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # the bytes differ from the identity body, the JSON does not
+        response.set_etag(etag, weak=True)
+    response.headers["Content-Encoding"] = encoding
+    return response
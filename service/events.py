@@ -0,0 +1,189 @@
+"""
+Product Events
+
+In-process publish/subscribe of Product changes for the Server-Sent
+Events stream at GET /products/events. The broker is a Product change
+listener, so every committed create, update, delete, enable or disable
+is pushed to the subscribers instead of being found by polling.
+
+Each subscriber has a bounded buffer. Publishing never blocks the
+request that wrote the change: when a client reads too slowly to keep
+up, its buffered events are dropped and replaced by a single "reset"
+event, which tells it to resync from GET /products/changes.
+
+Like the other in-process structures, a broker only sees the writes of
+its own worker process. Every open stream holds a gthread thread (or a
+gevent greenlet), so EVENTS_MAX_SUBSCRIBERS bounds them per worker.
+"""
+import logging
+import threading
+from collections import deque
+from service import fastjson
+
+logger = logging.getLogger("flask.app")
+
+# Event types a client can ask for with ?types=
+EVENT_TYPES = ("create", "update", "delete", "enable", "disable", "reset")
+
+# How long browsers wait before reconnecting a dropped stream
+RETRY_MS = 3000
+
+
+def event_type(action: str, data: dict, before: dict = None) -> str:
+    """Returns the event type of a Product change
+
+    An update that only flips the availability is an "enable" or "disable"
+    """
+    if action == "update" and before is not None:
+        if before["available"] != data["available"] and all(
+            before[key] == data[key] for key in data if key != "available"
+        ):
+            return "enable" if data["available"] else "disable"
+    return action
+
+
+def format_event(event: dict) -> bytes:
+    """Encodes an event in the text/event-stream format"""
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (
+        event["id"], event["type"].encode("ascii"), fastjson.dumps(event["data"])
+    )
+
+
+class Subscription:
+    """The bounded buffer of events of one client"""
+
+    def __init__(self, max_events: int, types=None):
+        self.max_events = max_events
+        self.types = set(types) if types else None
+        self.events = deque()
+        self.dropped = 0
+        self.closed = False
+        self._ready = threading.Condition()
+
+    def wants(self, event: dict) -> bool:
+        """Returns True if the client asked for this type of event"""
+        return self.types is None or event["type"] in self.types or event["type"] == "reset"
+
+    def put(self, event: dict) -> bool:
+        """Buffers an event, or replaces the buffer with a reset when it is full
+
+        Returns False when events were dropped
+        """
+        with self._ready:
+            if len(self.events) >= self.max_events:
+                self.dropped += len(self.events)
+                self.events.clear()
+                self.events.append({"id": event["id"], "type": "reset", "data": None})
+                self._ready.notify()
+                return False
+            self.events.append(event)
+            self._ready.notify()
+            return True
+
+    def get(self, timeout: float = None):
+        """Returns the next event, or None after timeout seconds or once closed"""
+        with self._ready:
+            self._ready.wait_for(lambda: self.events or self.closed, timeout)
+            if self.events:
+                return self.events.popleft()
+            return None
+
+    def close(self):
+        """Wakes up the reader so it can stop"""
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+
+
+class EventBroker:
+    """Fans Product changes out to the subscriptions of this process"""
+
+    def __init__(self, max_events: int = 1000, history: int = 1000, max_subscribers: int = 100):
+        self.max_events = max_events
+        self.max_subscribers = max_subscribers
+        self.history = deque(maxlen=history)
+        self.subscriptions = []
+        self.seq = 0
+        self.published = 0
+        self.overflows = 0
+        self._lock = threading.Lock()
+
+    def configure(self, max_events: int, history: int, max_subscribers: int):
+        """Sets the buffer sizes and the most clients at once"""
+        with self._lock:
+            self.max_events = max_events
+            self.max_subscribers = max_subscribers
+            self.history = deque(self.history, maxlen=history)
+
+    def subscribe(self, types=None, last_event_id: int = None):
+        """Returns a new Subscription, or None when there are too many
+
+        A client that reconnects with the id of the last event it saw gets
+        the events it missed replayed, or a reset if they are gone
+        """
+        with self._lock:
+            if len(self.subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(self.max_events, types)
+            if last_event_id is not None and last_event_id < self.seq:
+                oldest = self.history[0]["id"] if self.history else self.seq + 1
+                if last_event_id + 1 < oldest:
+                    subscription.put({"id": self.seq, "type": "reset", "data": None})
+                else:
+                    for event in self.history:
+                        if event["id"] > last_event_id and subscription.wants(event):
+                            subscription.put(event)
+            elif last_event_id is not None and last_event_id > self.seq:
+                # the id came from another process or before a restart
+                subscription.put({"id": self.seq, "type": "reset", "data": None})
+            self.subscriptions.append(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Removes a Subscription"""
+        subscription.close()
+        with self._lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, kind: str, data: dict) -> dict:
+        """Numbers an event and buffers it for every interested subscriber"""
+        with self._lock:
+            self.seq += 1
+            self.published += 1
+            event = {"id": self.seq, "type": kind, "data": data}
+            self.history.append(event)
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            if subscription.wants(event) and not subscription.put(event):
+                with self._lock:
+                    self.overflows += 1
+                logger.warning("Event subscriber fell behind, sending a reset")
+        return event
+
+    def on_product_change(self, action: str, data: dict, before: dict = None):
+        """Product change listener that publishes every change"""
+        self.publish(event_type(action, data, before), data)
+
+    def stats(self) -> dict:
+        """Returns the subscriber and event counters"""
+        with self._lock:
+            return {
+                "subscribers": len(self.subscriptions),
+                "seq": self.seq,
+                "published": self.published,
+                "overflows": self.overflows,
+            }
+
+
+# The broker of this process, configured in init_events()
+event_broker = EventBroker()
+
+
+def init_events(app):
+    """Configures the event broker from the Flask app config"""
+    event_broker.configure(
+        app.config["EVENTS_BUFFER_SIZE"],
+        app.config["EVENTS_HISTORY_SIZE"],
+        app.config["EVENTS_MAX_SUBSCRIBERS"],
+    )
@@ -0,0 +1,187 @@
+"""
+Product Facets
+
+Counts of Products per category and availability, with price ranges and
+histograms, kept as a summary that is O(categories) to read. The summary
+is loaded with one GROUP BY query and then updated in place by the
+Product change listeners, so creating, updating, deleting, enabling or
+disabling a Product never rescans the table.
+
+Each process only sees its own writes, so the summary is also reloaded
+after FACET_TTL seconds to pick up the changes made by other workers.
+"""
+import time
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+
+class CategoryFacet:
+    """The aggregates of one category"""
+
+    def __init__(self, buckets: int):
+        self.count = 0
+        self.available = 0
+        self.price_sum = 0.0
+        self.min_price = None
+        self.max_price = None
+        self.histogram = [0] * buckets
+
+    def add(self, count, available, price_sum, min_price, max_price, bucket):
+        """Adds Products that fall in the same price bucket"""
+        self.count += count
+        self.available += available
+        self.price_sum += price_sum
+        self.histogram[bucket] += count
+        if self.min_price is None or min_price < self.min_price:
+            self.min_price = min_price
+        if self.max_price is None or max_price > self.max_price:
+            self.max_price = max_price
+
+
+class FacetSummary:
+    """Facet counts and price statistics of the whole catalog"""
+
+    def __init__(self, bounds=(), ttl: float = 0, clock=time.monotonic):
+        self.bounds = tuple(bounds)
+        self.ttl = ttl
+        self.clock = clock
+        self.categories = {}
+        self.loaded = False
+        self.loaded_at = 0.0
+        self._lock = threading.RLock()
+
+    def configure(self, bounds, ttl: float):
+        """Sets the price bucket bounds and time to live, emptying the summary"""
+        with self._lock:
+            self.bounds = tuple(bounds)
+            self.ttl = ttl
+            self.clear()
+
+    def clear(self):
+        """Empties the summary so it is loaded again on the next read"""
+        with self._lock:
+            self.categories = {}
+            self.loaded = False
+
+    def is_current(self) -> bool:
+        """Returns True when the summary can be read without reloading it"""
+        return self.loaded and (not self.ttl or self.clock() - self.loaded_at < self.ttl)
+
+    def bucket(self, price: float) -> int:
+        """Returns the index of the histogram bucket of a price"""
+        for index, bound in enumerate(self.bounds):
+            if price <= bound:
+                return index
+        return len(self.bounds)
+
+    def load(self, rows):
+        """Replaces the summary with grouped rows
+
+        Args:
+            rows: (category, available, bucket, count, min, max, sum) rows
+                from a GROUP BY on category, availability and price bucket
+        """
+        with self._lock:
+            self.categories = {}
+            for category, available, bucket, count, min_price, max_price, price_sum in rows:
+                facet = self._facet(category)
+                facet.add(count, count if available else 0, price_sum, min_price, max_price, bucket)
+            self.loaded = True
+            self.loaded_at = self.clock()
+            logger.info("Facet summary loaded with %d categories", len(self.categories))
+
+    def on_product_change(self, action: str, data: dict, before: dict = None):
+        """Product change listener that updates the counts in place"""
+        with self._lock:
+            if not self.loaded:
+                return
+            if action == "reset" or (action == "update" and before is None):
+                self.clear()
+                return
+            if action == "update" and self._same_price(before, data):
+                # e.g. enable or disable: only the availability can change
+                facet = self.categories[data["category"]]
+                facet.available += int(bool(data["available"])) - int(bool(before["available"]))
+                return
+            if action in ("update", "delete"):
+                self._remove(before if action == "update" else data)
+            if action in ("create", "update") and self.loaded:
+                price = float(data["price"])
+                self._facet(data["category"]).add(
+                    1, 1 if data["available"] else 0, price, price, price, self.bucket(price)
+                )
+
+    def summary(self) -> dict:
+        """Returns the facets as a dictionary"""
+        with self._lock:
+            categories = []
+            totals = CategoryFacet(len(self.bounds) + 1)
+            for name in sorted(self.categories):
+                facet = self.categories[name]
+                categories.append(dict(self._describe(facet), category=name))
+                totals.count += facet.count
+                totals.available += facet.available
+                totals.price_sum += facet.price_sum
+                totals.histogram = [a + b for a, b in zip(totals.histogram, facet.histogram)]
+                for price in (facet.min_price, facet.max_price):
+                    if totals.min_price is None or price < totals.min_price:
+                        totals.min_price = price
+                    if totals.max_price is None or price > totals.max_price:
+                        totals.max_price = price
+            result = self._describe(totals)
+            result["categories"] = categories
+            return result
+
+    ##################################################################
+    # Unlocked helpers
+    ##################################################################
+    def _facet(self, category) -> CategoryFacet:
+        facet = self.categories.get(category)
+        if facet is None:
+            facet = self.categories[category] = CategoryFacet(len(self.bounds) + 1)
+        return facet
+
+    def _same_price(self, before, data) -> bool:
+        return (
+            before["category"] == data["category"]
+            and before["category"] in self.categories
+            and float(before["price"]) == float(data["price"])
+        )
+
+    def _remove(self, data):
+        facet = self.categories.get(data["category"])
+        price = float(data["price"])
+        # the new extremes are unknown once an extreme price goes away
+        if facet is None or price in (facet.min_price, facet.max_price):
+            self.clear()
+            return
+        facet.count -= 1
+        facet.available -= 1 if data["available"] else 0
+        facet.price_sum -= price
+        facet.histogram[self.bucket(price)] -= 1
+
+    def _describe(self, facet: CategoryFacet) -> dict:
+        histogram = []
+        for index, count in enumerate(facet.histogram):
+            bound = self.bounds[index] if index < len(self.bounds) else None
+            histogram.append({"max_price": bound, "count": count})
+        return {
+            "count": facet.count,
+            "available": facet.available,
+            "unavailable": facet.count - facet.available,
+            "min_price": facet.min_price,
+            "max_price": facet.max_price,
+            "avg_price": round(facet.price_sum / facet.count, 2) if facet.count else None,
+            "price_histogram": histogram,
+        }
+
+
+# The facet summary of this process, configured in init_facets()
+facet_summary = FacetSummary()
+
+
+def init_facets(app):
+    """Configures the facet summary from the Flask app config"""
+    facet_summary.configure(app.config["FACET_PRICE_BUCKETS"], app.config["FACET_TTL"])
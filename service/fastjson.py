@@ -0,0 +1,24 @@
+"""
+Fast JSON encoding
+
+Encodes response bodies straight to bytes, using orjson when it is
+installed and falling back to the standard library json module.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(data) -> bytes:
+    """Encodes data as compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def encoder_name() -> str:
+    """Returns the name of the encoder in use"""
+    return "orjson" if orjson is not None else "json"
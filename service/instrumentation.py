@@ -0,0 +1,200 @@
+"""
+Module: instrumentation
+
+Per-request timing and SQL instrumentation. Every request records its
+latency, number of SQL statements, time spent in the database and the
+size of the response. The totals are added to the response in a
+Server-Timing header and kept in per-route histograms that GET /metrics
+exposes in the Prometheus text format.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    """The measurements taken during a single request"""
+
+    def __init__(self, keep_statements: bool = False):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.timers = {}
+        # the statements themselves are only kept for the query detector
+        self.statements = [] if keep_statements else None
+
+    def add_statement(self, statement, duration, parameters=None):
+        """Records one SQL statement"""
+        self.sql_count += 1
+        self.sql_time += duration
+        if self.statements is not None:
+            self.statements.append((statement, parameters, duration))
+
+    def add_timer(self, name, duration):
+        """Adds time spent in a named phase such as serialization"""
+        self.timers[name] = self.timers.get(name, 0.0) + duration
+
+
+class RouteStats:
+    """Latency histogram and counters for one route"""
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.statuses = {}
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.response_bytes = 0
+
+    def observe(self, latency, status_code, metrics, size):
+        """Adds a finished request to the statistics"""
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[index] += 1
+        self.count += 1
+        self.latency_sum += latency
+        self.statuses[status_code] = self.statuses.get(status_code, 0) + 1
+        self.sql_count += metrics.sql_count
+        self.sql_time += metrics.sql_time
+        self.response_bytes += size
+
+
+class Registry:
+    """Holds the statistics of every route"""
+
+    def __init__(self):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, latency, status_code, metrics, size):
+        """Records a finished request"""
+        with self._lock:
+            stats = self.routes.setdefault((method, route), RouteStats())
+            stats.observe(latency, status_code, metrics, size)
+
+    def reset(self):
+        """Forgets every measurement"""
+        with self._lock:
+            self.routes = {}
+
+    def render(self, gauges=None) -> str:
+        """Returns the statistics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP http_request_duration_seconds Request latency by route",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        with self._lock:
+            routes = sorted(self.routes.items())
+            for (method, route), stats in routes:
+                labels = 'method="{}",route="{}"'.format(method, route)
+                for bound, count in zip(LATENCY_BUCKETS, stats.buckets):
+                    lines.append(
+                        'http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count)
+                    )
+                lines.append('http_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, stats.count))
+                lines.append("http_request_duration_seconds_sum{{{}}} {}".format(labels, stats.latency_sum))
+                lines.append("http_request_duration_seconds_count{{{}}} {}".format(labels, stats.count))
+            lines += [
+                "# HELP http_requests_total Requests by route and status",
+                "# TYPE http_requests_total counter",
+            ]
+            for (method, route), stats in routes:
+                for status_code, count in sorted(stats.statuses.items()):
+                    lines.append(
+                        'http_requests_total{{method="{}",route="{}",status="{}"}} {}'.format(
+                            method, route, status_code, count
+                        )
+                    )
+            counters = [
+                ("db_statements_total", "SQL statements executed by route", "sql_count"),
+                ("db_time_seconds_total", "Time spent executing SQL by route", "sql_time"),
+                ("http_response_bytes_total", "Bytes sent in response bodies by route", "response_bytes"),
+            ]
+            for name, description, attribute in counters:
+                lines += ["# HELP {} {}".format(name, description), "# TYPE {} counter".format(name)]
+                for (method, route), stats in routes:
+                    lines.append(
+                        '{}{{method="{}",route="{}"}} {}'.format(name, method, route, getattr(stats, attribute))
+                    )
+        for name, value in sorted((gauges or {}).items()):
+            lines += ["# TYPE {} gauge".format(name), "{} {}".format(name, value)]
+        return "\n".join(lines) + "\n"
+
+
+# The statistics of this process, exposed by GET /metrics
+registry = Registry()
+
+
+def current():
+    """Returns the metrics of the request being handled, or None"""
+    if has_request_context():
+        return g.get("request_metrics")
+    return None
+
+
+@contextmanager
+def timer(name):
+    """Measures a phase of the current request for the Server-Timing header"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current()
+        if metrics is not None:
+            metrics.add_timer(name, time.perf_counter() - start)
+
+
+######################################################################
+# SQLAlchemy engine events
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+    """Remembers when a statement started"""
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+    """Adds a finished statement to the current request"""
+    duration = time.perf_counter() - conn.info["query_start_time"].pop()
+    metrics = current()
+    if metrics is not None:
+        metrics.add_statement(statement, duration, None if executemany else parameters)
+
+
+######################################################################
+# Flask request hooks
+######################################################################
+@app.before_request
+def start_request_metrics():
+    """Starts measuring a request"""
+    g.request_metrics = RequestMetrics(app.config.get("QUERY_DETECTOR_ENABLED", False))
+
+
+@app.after_request
+def finish_request_metrics(response):
+    """Adds the Server-Timing header and records the request"""
+    metrics = g.pop("request_metrics", None)
+    if metrics is None:
+        return response
+    latency = time.perf_counter() - metrics.start
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    # streamed bodies are still being generated, so their size is unknown;
+    # calculate_content_length() would buffer them
+    size = 0 if response.is_streamed else response.calculate_content_length() or 0
+    registry.observe(request.method, route, latency, response.status_code, metrics, size)
+
+    timings = ['db;dur={:.3f};desc="{} queries"'.format(metrics.sql_time * 1000, metrics.sql_count)]
+    for name, duration in metrics.timers.items():
+        timings.append("{};dur={:.3f}".format(name, duration * 1000))
+    timings.append("total;dur={:.3f}".format(latency * 1000))
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
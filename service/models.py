@@ -3,25 +3,131 @@ Models for Product
 
 All of the models are stored in this module
 """
+import base64
+import binascii
+import json
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime, timezone
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 from flask import Flask
+from service.cache import product_cache, init_cache
+from service.pool import init_pool
+from service.search import search_index, tokenize
+from service.facets import facet_summary, init_facets
+from service.write_behind import init_write_behind
+from service.events import event_broker, init_events
+from service.replicas import RoutingSQLAlchemy, REPLICA_OPTION, init_replicas
 
 logger = logging.getLogger("flask.app")
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_db(); its
+# sessions send the queries of Product.replica_query() to read replicas
+db = RoutingSQLAlchemy()
+
+# Maximum number of ids bound into a single IN (...) clause
+BULK_CHUNK_SIZE = 500
+
+# Most bound parameters in one statement on old SQLite builds
+SQLITE_MAX_VARIABLES = 999
+
+# Functions called with (action, data) after every committed change
+listeners = []
+
+# Text search configuration of the PostgreSQL name index
+SEARCH_CONFIG = db.literal_column("'simple'")
+
+# Numbers every change to the catalog on PostgreSQL, see next_change_seq
+CHANGE_SEQUENCE = db.Sequence("product_change_seq", metadata=db.Model.metadata)
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class DataConflictError(Exception):
+    """ Used when a change conflicts with the stored data, e.g. a taken sku """
+
+
+class DataStaleError(DataConflictError):
+    """ Used when a conditional change finds the stored data already changed """
+
+
 def init_db(app):
     """Initialize the SQLAlchemy app"""
     Product.init_db(app)
 
 
+def commit(flush_only: bool = False):
+    """Commits (or flushes) the session, reporting unique key violations
+
+    Raises a DataConflictError, after rolling back, when a change would
+    store a value that must be unique twice, such as a sku
+    """
+    try:
+        if flush_only:
+            db.session.flush()
+        else:
+            db.session.commit()
+    except IntegrityError as error:
+        db.session.rollback()
+        raise DataConflictError("Conflicting Product: {}".format(error.orig))
+
+
+def utcnow() -> datetime:
+    """Returns the current UTC time without a time zone, as it is stored"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class next_change_seq(FunctionElement):  # pylint: disable=invalid-name
+    """SQL expression for the next number of the catalog change sequence
+
+    PostgreSQL draws it from CHANGE_SEQUENCE. Other databases have no
+    sequences, so it is one more than the newest change; SQLite runs one
+    write at a time, which keeps it increasing across processes, but rows
+    written by the same statement may share a number.
+    """
+
+    type = db.BigInteger()
+    name = "next_change_seq"
+    inherit_cache = True
+
+
+@compiles(next_change_seq)
+def _compile_next_change_seq(element, compiler, **kw):  # pylint: disable=unused-argument
+    return (
+        "(SELECT coalesce(max(seq), 0) + 1 FROM ("
+        "SELECT max(change_seq) AS seq FROM product "
+        "UNION ALL SELECT max(change_seq) FROM product_tombstone))"
+    )
+
+
+@compiles(next_change_seq, "postgresql")
+def _compile_next_change_seq_postgresql(element, compiler, **kw):  # pylint: disable=unused-argument
+    return compiler.process(CHANGE_SEQUENCE.next_value(), **kw)
+
+
+class ProductTombstone(db.Model):
+    """
+    Class that records a deleted Product for the change feed
+    """
+
+    __tablename__ = "product_tombstone"
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    sku = db.Column(db.String(63), nullable=True)
+    change_seq = db.Column(db.BigInteger, nullable=False, default=next_change_seq())
+    deleted_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    __table_args__ = (
+        # the deletes after a checkpoint, in change order
+        db.Index("ix_product_tombstone_change_seq", "change_seq", "product_id"),
+    )
+
+
 class Product(db.Model):
     """
     Class that represents a Product
@@ -33,8 +139,48 @@ class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(63), nullable=False)
     category = db.Column(db.String(63), nullable=False)
-    available = db.Column(db.Boolean(), nullable=False, default=False)
+    available = db.Column(db.Boolean(), nullable=False, default=False, index=True)
     price = db.Column(db.Float(), nullable=False)
+    # the key of the Product in the upstream ERP, for upserts
+    sku = db.Column(db.String(63), nullable=True, unique=True)
+    # set by every INSERT and UPDATE, including bulk and Core statements
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
+    change_seq = db.Column(
+        db.BigInteger, nullable=False, default=next_change_seq(), onupdate=next_change_seq()
+    )
+
+    __table_args__ = (
+        # serves category + availability + price range filters in one scan
+        db.Index("ix_product_category_available_price", "category", "available", "price"),
+        # (column, id) indexes serve both the filters on a column and the
+        # ORDER BY column, id of each sort key, in either direction
+        db.Index("ix_product_name_id", "name", "id"),
+        db.Index("ix_product_price_id", "price", "id"),
+        db.Index("ix_product_category_id", "category", "id"),
+        # the cheapest (or dearest) Products of a category, page by page
+        db.Index("ix_product_category_price_id", "category", "price", "id"),
+        # the changes after a checkpoint, in change order
+        db.Index("ix_product_change_seq_id", "change_seq", "id"),
+    )
+
+    # Columns that serialize() returns, in order
+    FIELDS = ("id", "name", "category", "price", "available", "sku")
+
+    # Columns that Products can be ordered by when paginating
+    SORT_KEYS = ("id", "name", "category", "price")
+
+    # The sort key of cursors for ranked search results
+    SEARCH_SORT = "rank"
+
+    # The type of the last value in a cursor for each sort key
+    CURSOR_TYPES = {
+        "id": int,
+        "name": str,
+        "category": str,
+        "price": (int, float),
+        "rank": (int, float),
+        "change_seq": int,
+    }
 
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.name, self.id)
@@ -46,20 +192,328 @@ class Product(db.Model):
         logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
-        db.session.commit()
+        commit()
+        self.notify("create", self.serialize())
 
-    def update(self):
+    def update(self, expected_seq: int = None):
         """
         Updates a Product to the database
+
+        With an expected_seq the Product is only saved if its change_seq is
+        still that number, checked by the UPDATE itself so that of two
+        concurrent writers only the first one succeeds
         """
         logger.info("Saving %s", self.name)
-        db.session.commit()
+        before = self.loaded_data()
+        if expected_seq is not None:
+            # claims the row (locking it on PostgreSQL) before the ORM writes
+            # it; a change committed since it was read has moved change_seq on
+            table = Product.__table__
+            claim = table.update().where(table.c.id == self.id, table.c.change_seq == expected_seq)
+            claim = claim.values(change_seq=table.c.change_seq, updated_at=table.c.updated_at)
+            if db.session.connection().execute(claim).rowcount != 1:
+                db.session.rollback()
+                raise DataStaleError("Product with id '{}' was modified by another request.".format(self.id))
+        commit()
+        # reloaded after the commit, so listeners get the values as stored
+        self.notify("update", self.serialize(), before)
 
     def delete(self):
         """ Removes a Product from the data store """
         logger.info("Deleting %s", self.name)
+        data = self.serialize()
         db.session.delete(self)
         db.session.commit()
+        self.notify("delete", data)
+
+    @classmethod
+    def bulk_create(cls, items: list):
+        """Creates many Products in a single transaction
+
+        Every item is validated first; the valid ones are inserted together
+        with one commit and the invalid ones are reported back by position.
+
+        :param items: a list of dictionaries containing the resource data
+        :type items: list
+        :return: the data of the Products that were created and the errors
+            for the rest
+        :rtype: tuple
+        """
+        logger.info("Bulk creating %d Products", len(items))
+        products, errors = [], []
+        for index, data in enumerate(items):
+            try:
+                products.append(cls().deserialize(data))
+            except DataValidationError as error:
+                errors.append({"index": index, "error": str(error)})
+        # the unit of work batches these INSERTs (with RETURNING for the ids)
+        db.session.add_all(products)
+        commit(flush_only=True)
+        ids = [product.id for product in products]
+        db.session.commit()
+        # read back in chunks instead of refreshing each expired Product
+        stored = cls.stored_data(ids)
+        results = [stored[product_id] for product_id in ids]
+        for data in results:
+            cls.notify("create", data)
+        return results, errors
+
+    @classmethod
+    def bulk_update(cls, items: list):
+        """Updates many Products in a single transaction
+
+        Each item must carry the id of the Product it replaces. Rows are
+        written with one executemany UPDATE and a single commit.
+
+        :param items: a list of dictionaries containing the resource data
+        :type items: list
+        :return: the data that was saved and the errors for the rest
+        :rtype: tuple
+        """
+        logger.info("Bulk updating %d Products", len(items))
+        mappings, errors = [], []
+        for index, data in enumerate(items):
+            try:
+                product = cls().deserialize(data)
+                product_id = data.get("id")
+                if not isinstance(product_id, int) or isinstance(product_id, bool):
+                    raise DataValidationError("Invalid Product: missing id")
+            except DataValidationError as error:
+                errors.append({"index": index, "error": str(error)})
+                continue
+            mapping = product.serialize()
+            mapping["id"] = product_id
+            if "sku" not in data:
+                del mapping["sku"]
+            mappings.append((index, mapping))
+
+        # the stored rows, so listeners also learn what each update replaced
+        existing = cls.stored_data([mapping["id"] for _, mapping in mappings])
+        found = []
+        for index, mapping in mappings:
+            if mapping["id"] in existing:
+                found.append(mapping)
+            else:
+                message = "Product with id '{}' was not found.".format(mapping["id"])
+                errors.append({"index": index, "error": message})
+        db.session.bulk_update_mappings(cls, found)
+        commit()
+        stored = cls.stored_data([mapping["id"] for mapping in found])
+        results = [stored[mapping["id"]] for mapping in found]
+        for data in results:
+            cls.notify("update", data, existing[data["id"]])
+        errors.sort(key=lambda error: error["index"])
+        return results, errors
+
+    @classmethod
+    def bulk_delete(cls, query=None) -> int:
+        """Removes every Product matched by a query with one DELETE statement
+
+        :param query: a query of the Products to delete, e.g. from
+            find_by_filters(); all Products are removed when it is None
+        :return: the number of Products that were deleted
+        :rtype: int
+        """
+        logger.info("Bulk deleting Products")
+        if query is None:
+            query = cls.query
+        # tombstones for the change feed, written by the same transaction
+        rows = query.with_entities(cls.id, cls.sku, next_change_seq(), db.literal(utcnow(), db.DateTime))
+        db.session.execute(
+            ProductTombstone.__table__.insert().from_select(
+                ["product_id", "sku", "change_seq", "deleted_at"], rows.statement
+            )
+        )
+        count = query.delete(synchronize_session=False)
+        db.session.commit()
+        # the deleted rows are unknown, so every listener starts over
+        cls.notify("reset", None)
+        return count
+
+    @classmethod
+    def upsert(cls, items: list):
+        """Creates or updates many Products keyed on their sku
+
+        Every item must carry a sku. The Products are written with native
+        INSERT ... ON CONFLICT (sku) DO UPDATE statements, so sending the
+        same batch twice leaves the same rows behind. When a sku appears
+        more than once in a batch the last item wins.
+
+        :param items: a list of dictionaries containing the resource data
+        :type items: list
+        :return: the (data, created) of every Product that was saved and
+            the errors for the rest
+        :rtype: tuple
+        """
+        logger.info("Upserting %d Products", len(items))
+        rows, errors = {}, []
+        for index, data in enumerate(items):
+            try:
+                row = cls().deserialize(data).serialize()
+                cls.check_sku(data.get("sku"))
+            except DataValidationError as error:
+                errors.append({"index": index, "error": str(error)})
+                continue
+            del row["id"]
+            row["updated_at"] = utcnow()
+            rows.pop(row["sku"], None)
+            rows[row["sku"]] = row
+        rows = list(rows.values())
+        if not rows:
+            return [], errors
+
+        if db.engine.dialect.name == "postgresql":
+            saved = cls._upsert_postgres(rows)
+        else:
+            saved = []
+            size = SQLITE_MAX_VARIABLES // len(rows[0])
+            for start in range(0, len(rows), size):
+                saved += cls._upsert_sqlite(rows[start:start + size])
+        commit()
+        for data, created, before in saved:
+            cls.notify("create" if created else "update", data, before)
+        return [(data, created) for data, created, _ in saved], errors
+
+    @classmethod
+    def _upsert_statement(cls, insert, rows):
+        """Returns an INSERT ... ON CONFLICT (sku) DO UPDATE of the rows"""
+        statement = insert(cls.__table__).values(rows)
+        # ON CONFLICT DO UPDATE does not apply the column onupdate defaults
+        set_ = {key: statement.excluded[key] for key in rows[0] if key != "sku"}
+        set_["change_seq"] = next_change_seq()
+        return statement.on_conflict_do_update(index_elements=[cls.__table__.c.sku], set_=set_)
+
+    @classmethod
+    def _upsert_postgres(cls, rows) -> list:
+        """Upserts the rows in one statement
+
+        Returns (data, created, before) for each row; what an update replaced
+        is not returned, so before is always None
+        """
+        columns = [cls.__table__.c[field] for field in cls.FIELDS]
+        # a row that was just inserted has no previous version (xmax = 0)
+        inserted = db.literal_column("(xmax = 0)").label("inserted")
+        statement = cls._upsert_statement(postgresql.insert, rows).returning(*columns, inserted)
+        return [
+            (cls.serialize_fields(row, cls.FIELDS), row.inserted, None)
+            for row in db.session.execute(statement)
+        ]
+
+    @classmethod
+    def _upsert_sqlite(cls, rows) -> list:
+        """Upserts the rows, reading them before and after since there is no RETURNING
+
+        Returns (data, created, before) for each row
+        """
+        skus = [row["sku"] for row in rows]
+        query = cls.select_fields(cls.FIELDS, cls.query.filter(cls.sku.in_(skus)))
+        before = {row.sku: cls.serialize_fields(row, cls.FIELDS) for row in query}
+        db.session.execute(cls._upsert_statement(sqlite.insert, rows))
+        after = {row.sku: cls.serialize_fields(row, cls.FIELDS) for row in query}
+        return [(after[sku], sku not in before, before.get(sku)) for sku in skus]
+
+    @classmethod
+    def set_available(cls, product_id: int, available: bool):
+        """Sets the availability of a Product without loading it first
+
+        The flag is written with a single UPDATE (RETURNING the row on
+        PostgreSQL) instead of a read, a deserialize and a full-row write.
+
+        :param product_id: the id of the Product to change
+        :type product_id: int
+        :param available: the new availability
+        :type available: bool
+        :return: the serialized Product, or None if it does not exist
+        :rtype: dict
+        """
+        logger.info("Setting availability of %s to %s", product_id, available)
+        changed = cls._set_available(available, [cls.id == product_id])
+        cls._commit_available(changed, available)
+        if changed:
+            return changed[0]
+        # nothing changed, so the Product is missing or already in that state
+        return cls.find_serialized(product_id)
+
+    @classmethod
+    def bulk_set_available(cls, available: bool, ids: list = None, criteria=()) -> int:
+        """Sets the availability of many Products in one transaction
+
+        Only the Products whose availability actually changes are written.
+        On PostgreSQL each call is a single UPDATE ... RETURNING; other
+        databases bind at most BULK_CHUNK_SIZE ids per statement.
+
+        :param available: the new availability
+        :type available: bool
+        :param ids: the ids of the Products to change, or None for all the
+            Products matching the criteria
+        :type ids: list
+        :param criteria: extra SQL criteria, e.g. from filter_clauses()
+        :return: the number of Products that changed
+        :rtype: int
+        """
+        logger.info("Bulk setting availability to %s", available)
+        if ids is None:
+            changed = cls._set_available(available, list(criteria))
+        elif any(not isinstance(product_id, int) or isinstance(product_id, bool) for product_id in ids):
+            raise DataValidationError("Invalid ids: must be a list of integers")
+        elif db.engine.dialect.name == "postgresql":
+            # one array parameter instead of one bound parameter per id
+            id_array = db.bindparam("ids", ids, type_=postgresql.ARRAY(db.Integer))
+            changed = cls._set_available(available, [cls.id == db.any_(id_array), *criteria])
+        else:
+            changed = []
+            for start in range(0, len(ids), BULK_CHUNK_SIZE):
+                chunk = ids[start:start + BULK_CHUNK_SIZE]
+                changed += cls._set_available(available, [cls.id.in_(chunk), *criteria])
+        cls._commit_available(changed, available)
+        return len(changed)
+
+    @classmethod
+    def _set_available(cls, available: bool, criteria: list) -> list:
+        """Updates the matching Products whose availability differs
+
+        Returns the serialized Products that will change on commit
+        """
+        table = cls.__table__
+        columns = [table.c[field] for field in cls.FIELDS]
+        criteria = [table.c.available != available, *criteria]
+        statement = table.update().where(*criteria).values(available=available)
+        if db.engine.dialect.name == "postgresql":
+            rows = db.session.execute(statement.returning(*columns))
+            changed = [cls.serialize_fields(row, cls.FIELDS) for row in rows]
+        else:
+            # without RETURNING, read the rows that are about to change first
+            rows = db.session.execute(db.select(*columns).where(*criteria))
+            changed = [dict(cls.serialize_fields(row, cls.FIELDS), available=available) for row in rows]
+            if changed:
+                db.session.execute(statement)
+        return changed
+
+    @classmethod
+    def _commit_available(cls, changed: list, available: bool):
+        """Commits availability changes and tells the listeners about them"""
+        db.session.commit()
+        for data in changed:
+            cls.notify("update", data, dict(data, available=not available))
+
+    @staticmethod
+    def add_listener(listener):
+        """Calls listener(action, data, before) after every committed change
+
+        The action is "create", "update" or "delete" with the serialized
+        Product as data, or "reset" with None when an unknown set of Products
+        changed at once (e.g. bulk_delete()). Updates also pass the Product as
+        it was before, or None when that is unknown. The product cache, the
+        search index and the facet summary stay consistent this way, and
+        the event broker pushes the changes to its subscribers.
+        """
+        listeners.append(listener)
+
+    @staticmethod
+    def notify(action: str, data: dict, before: dict = None):
+        """Tells every listener about a committed change"""
+        for listener in listeners:
+            listener(action, data, before)
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
@@ -67,9 +521,40 @@ class Product(db.Model):
         "name": self.name,
         "category": self.category,
         "price": self.price,
-        "available": self.available
+        "available": self.available,
+        "sku": self.sku,
         }
 
+    def loaded_data(self):
+        """Serializes a Product as it was loaded, ignoring unsaved changes
+
+        Returns None when a column was changed without its old value ever
+        being loaded, since the stored value is then unknown
+        """
+        state = db.inspect(self)
+        data = {}
+        for field in self.FIELDS:
+            if field in state.unloaded:
+                return None
+            history = state.attrs[field].history
+            if history.deleted:
+                data[field] = history.deleted[0]
+            elif history.added:
+                return None
+            else:
+                data[field] = getattr(self, field)
+        return data
+
+    @staticmethod
+    def serialize_fields(row, fields) -> dict:
+        """Serializes a row returned by a select_fields() query
+
+        Args:
+            row: a row whose leading columns are the given fields, in order
+            fields (list): the names of the columns to include
+        """
+        return dict(zip(fields, row))
+
     def deserialize(self, data: dict):
         """
         Deserializes a Product from a dictionary
@@ -88,6 +573,9 @@ class Product(db.Model):
                     "Invalid type for boolean [available]: "
                     + str(type(data["available"]))
                 )
+            # the sku is optional and kept as it is when it is not sent
+            if "sku" in data:
+                self.sku = self.check_sku(data["sku"], allow_none=True)
         except KeyError as error:
             raise DataValidationError(
                 "Invalid Product: missing " + error.args[0]
@@ -98,27 +586,176 @@ class Product(db.Model):
             )
         return self
 
+    @staticmethod
+    def check_sku(sku, allow_none: bool = False):
+        """Returns a valid sku or raises a DataValidationError"""
+        if sku is None and allow_none:
+            return None
+        if not isinstance(sku, str) or not sku.strip() or len(sku) > 63:
+            raise DataValidationError("Invalid sku: must be a string of 1 to 63 characters")
+        return sku
+
     @classmethod
     def init_db(cls, app: Flask):
         """ Initializes the database session """
         logger.info("Initializing database")
         #cls.app = app
         # This is where we initialize SQLAlchemy from the Flask app
+        init_pool(app)
         db.init_app(app)
+        init_replicas(app, db)
+        init_cache(app)
+        init_facets(app)
+        init_events(app)
+        init_write_behind(app, cls.bulk_update)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        # only on the primary: the replicas are read-only and may be down
+        db.create_all(bind=None)  # make our sqlalchemy tables
+        cls.upgrade_schema()
+
+    @classmethod
+    def upgrade_schema(cls):
+        """Adds the columns and indexes that db.create_all() leaves out
+
+        create_all() only creates the missing tables, so a product table made
+        by an older version lacks the columns and indexes added since, and
+        every query of it fails. Nothing is done on an up to date database.
+        """
+        table = cls.__table__
+        inspector = db.inspect(db.engine)
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        unique = [constraint["column_names"] for constraint in inspector.get_unique_constraints(table.name)]
+        unique += [index["column_names"] for index in inspector.get_indexes(table.name) if index["unique"]]
+        preparer = db.engine.dialect.identifier_preparer
+        postgres = db.engine.dialect.name == "postgresql"
+        # the values of the rows that predate a NOT NULL column; they become
+        # the first changes of the feed, in id order without a sequence
+        backfill = {
+            "updated_at": ":now",
+            "change_seq": "nextval('{}')".format(CHANGE_SEQUENCE.name) if postgres else "id",
+        }
+        with db.engine.begin() as conn:
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                logger.warning("Upgrading the schema: adding column %s.%s", table.name, column.name)
+                names = (preparer.format_table(table), preparer.format_column(column))
+                conn.execute(db.text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    *names, column.type.compile(dialect=db.engine.dialect)
+                )))
+                if column.name in backfill:
+                    statement = "UPDATE {} SET {} = {}".format(*names, backfill[column.name])
+                    conn.execute(db.text(statement), {"now": utcnow()} if ":now" in statement else {})
+                if not column.nullable and postgres:
+                    # SQLite cannot add the constraint later, the models always set these
+                    conn.execute(db.text("ALTER TABLE {} ALTER COLUMN {} SET NOT NULL".format(*names)))
+            if ["sku"] not in unique:
+                # what ON CONFLICT (sku) of upsert() needs
+                logger.warning("Upgrading the schema: adding a unique index on %s.sku", table.name)
+                conn.execute(db.text("CREATE UNIQUE INDEX uq_product_sku ON {} (sku)".format(
+                    preparer.format_table(table)
+                )))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    logger.warning("Upgrading the schema: adding index %s", index.name)
+                    index.create(conn)
+            # reflection skips expression indexes, so look the name up; the
+            # after_create hook only adds it along with a new table
+            search_index = "SELECT to_regclass('ix_product_name_search')"
+            if postgres and conn.execute(db.text(search_index)).scalar() is None:
+                logger.warning("Upgrading the schema: adding index ix_product_name_search")
+                conn.execute(SEARCH_INDEX.against(table))
 
     @classmethod
     def all(cls):
         """ Returns all of the Products in the database """
         logger.info("Processing all Products")
-        return cls.query.all()
+        return cls.replica_query().all()
+
+    @classmethod
+    def replica_query(cls):
+        """Returns a query of Products that a read replica may answer
+
+        The replica may lag behind the primary, so only use it for reads
+        whose results are not written back; requests that write, and the
+        sessions that have written, always read from the primary
+        """
+        return cls.query.execution_options(**{REPLICA_OPTION: True})
+
+    @classmethod
+    def iterate(cls, query=None, batch_size: int = 1000, sort: str = "id"):
+        """Iterates over Products without loading them all into memory
+
+        Rows are fetched from a server-side cursor in batches of batch_size,
+        so memory stays flat no matter how many Products are exported.
+
+        :param query: a query to iterate, e.g. from find_by_category()
+        :param batch_size: the number of rows to fetch per round-trip
+        :type batch_size: int
+        :param sort: the column to order by, see sort_order()
+        :type sort: str
+        :return: a generator of Products in the sort order
+        """
+        logger.info("Processing streamed query ...")
+        if query is None:
+            query = cls.query
+        return query.order_by(*cls.sort_order(sort)).yield_per(batch_size)
+
+    @classmethod
+    def select_fields(cls, fields, query=None):
+        """Restricts a query to only load some of the columns
+
+        The query returns lightweight rows instead of Product instances, so
+        neither the unused columns nor the ORM objects are ever built.
+
+        :param fields: the names of the columns to load, from FIELDS
+        :type fields: list
+        :param query: a query to restrict, e.g. from find_by_filters()
+        :return: a query of rows with only those columns
+        """
+        unknown = [field for field in fields if field not in cls.FIELDS]
+        if unknown:
+            raise DataValidationError("Invalid fields: " + ", ".join(unknown))
+        if query is None:
+            query = cls.query
+        return query.with_entities(*[getattr(cls, field) for field in fields])
+
+    @classmethod
+    def stored_data(cls, ids: list) -> dict:
+        """Returns the serialized Products with the given ids, by id
+
+        The values are read back from the database, so they are what was
+        stored (e.g. a price sent as "12.50" comes back as 12.5)
+        """
+        data = {}
+        for start in range(0, len(ids), BULK_CHUNK_SIZE):
+            chunk = ids[start:start + BULK_CHUNK_SIZE]
+            query = cls.select_fields(cls.FIELDS, cls.query.filter(cls.id.in_(chunk)))
+            data.update((row.id, cls.serialize_fields(row, cls.FIELDS)) for row in query)
+        return data
 
     @classmethod
     def find(cls, by_id):
         """ Finds a Product by it's ID """
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        return cls.replica_query().get(by_id)
+
+    @classmethod
+    def find_serialized(cls, by_id):
+        """Returns the serialized Product with the given id, or None
+
+        Reads go through the product cache so repeated lookups of the same
+        Product skip both the database and serialize()
+        """
+        data = product_cache.get(by_id)
+        if data is None:
+            product = cls.find(by_id)
+            if not product:
+                return None
+            data = product.serialize()
+            product_cache.set(by_id, data)
+        return dict(data)
 
     @classmethod
     def find_by_name(cls, name):
@@ -128,7 +765,7 @@ class Product(db.Model):
             name (string): the name of the Product you want to match
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.replica_query().filter(cls.name == name)
 
     @classmethod
     def find_by_availability(cls, available: bool = True) -> list:
@@ -140,7 +777,7 @@ class Product(db.Model):
         :rtype: list
         """
         logger.info("Processing available query for %s ...", available)
-        return cls.query.filter(cls.available == available)
+        return cls.replica_query().filter(cls.available == available)
 
     @classmethod
     def find_by_category(cls, category: str) -> list:
@@ -151,7 +788,68 @@ class Product(db.Model):
         :rtype: list
         """
         logger.info("Processing category query for %s ...", category)
-        return cls.query.filter(cls.category == category)
+        return cls.replica_query().filter(cls.category == category)
+
+    @classmethod
+    def find_by_filters(
+        cls,
+        category: str = None,
+        name: str = None,
+        available: bool = None,
+        minimum: float = None,
+        maximum: float = None,
+    ):
+        """Returns all of the Products that match every given filter
+
+        Filters that are None are ignored, the rest are combined with AND
+        into a single SQL statement.
+
+        :param category: the category of the Products you want to match
+        :type category: str
+        :param name: the name of the Products you want to match
+        :type name: str
+        :param available: True for products that are available
+        :type available: bool
+        :param minimum: the lowest price to match
+        :type minimum: float
+        :param maximum: the highest price to match
+        :type maximum: float
+        :return: a query of the Products that match
+        """
+        logger.info(
+            "Processing filter query category=%s name=%s available=%s price=%s-%s ...",
+            category, name, available, minimum, maximum,
+        )
+        return cls.replica_query().filter(
+            *cls.filter_clauses(category, name, available, minimum, maximum)
+        )
+
+    @classmethod
+    def filter_clauses(
+        cls,
+        category: str = None,
+        name: str = None,
+        available: bool = None,
+        minimum: float = None,
+        maximum: float = None,
+    ) -> list:
+        """Returns the SQL criteria for the filters that are not None
+
+        These are shared by find_by_filters() and the async service, which
+        cannot use the Flask-SQLAlchemy query property
+        """
+        clauses = []
+        if category is not None:
+            clauses.append(cls.category == category)
+        if name is not None:
+            clauses.append(cls.name == name)
+        if available is not None:
+            clauses.append(cls.available == available)
+        if minimum is not None:
+            clauses.append(cls.price >= minimum)
+        if maximum is not None:
+            clauses.append(cls.price <= maximum)
+        return clauses
 
     @classmethod
     def find_or_404(cls, product_id: int):
@@ -162,7 +860,7 @@ class Product(db.Model):
         :rtype: Product
         """
         logger.info("Processing lookup or 404 for id %s ...", product_id)
-        return cls.query.get_or_404(product_id)
+        return cls.replica_query().get_or_404(product_id)
 
     @classmethod
     def query_by_price(cls, minimum: float, maximum: float):
@@ -172,4 +870,306 @@ class Product(db.Model):
         :return: a collection of Products match the price range
         :rtype: list
         """
-        return cls.query.filter(cls.price.between(minimum, maximum))
\ No newline at end of file
+        return cls.replica_query().filter(cls.price.between(minimum, maximum))
+
+    @classmethod
+    def paginate(cls, limit: int, cursor: str = None, sort: str = "id", query=None):
+        """Returns one page of Products using keyset (cursor) pagination
+
+        Rows are ordered by the sort key with the id as a tie breaker, and the
+        next page starts strictly after the last row returned, so every page is
+        a bounded index range scan instead of a full table read.
+
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param cursor: the opaque cursor returned with the previous page
+        :type cursor: str
+        :param sort: the column to order by, prefixed with '-' for descending
+        :type sort: str
+        :param query: a query to paginate, e.g. from find_by_category()
+        :return: the Products in the page and the cursor for the next page
+            (None when there are no more Products)
+        :rtype: tuple
+        """
+        logger.info("Processing page query limit=%s sort=%s ...", limit, sort)
+        order = cls.sort_order(sort)
+        if query is None:
+            query = cls.query
+        if cursor:
+            query = query.filter(cls.after_cursor(cursor, sort))
+        query = query.order_by(*order)
+
+        # fetch one extra row to find out if there is a next page
+        rows = query.limit(limit + 1).all()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, cls.encode_cursor(sort, getattr(last, sort.lstrip("-")), last.id)
+
+    @classmethod
+    def sort_order(cls, sort: str = "id") -> list:
+        """Returns the ORDER BY clauses of a sort key
+
+        The id breaks ties, so the order matches the (column, id) indexes and
+        is stable enough for keyset cursors.
+
+        :param sort: a column from SORT_KEYS, prefixed with '-' for descending
+        :type sort: str
+        :return: the clauses to pass to order_by()
+        :rtype: list
+        """
+        descending = sort.startswith("-")
+        key = sort[1:] if descending else sort
+        if key not in cls.SORT_KEYS:
+            raise DataValidationError(
+                "Invalid sort key: {} (use one of {})".format(sort, ", ".join(cls.SORT_KEYS))
+            )
+        columns = [getattr(cls, key)] if key == "id" else [getattr(cls, key), cls.id]
+        return [column.desc() if descending else column.asc() for column in columns]
+
+    @classmethod
+    def after_cursor(cls, cursor: str, sort: str = "id"):
+        """Returns the criterion for the rows after a cursor in a sort order"""
+        last_value, last_id = cls.decode_cursor(cursor, sort)
+        descending = sort.startswith("-")
+        key = sort.lstrip("-")
+        column = getattr(cls, key)
+        if key == "id":
+            return cls.id < last_id if descending else cls.id > last_id
+        if descending:
+            return db.or_(column < last_value, db.and_(column == last_value, cls.id < last_id))
+        return db.or_(column > last_value, db.and_(column == last_value, cls.id > last_id))
+
+    @classmethod
+    def search(cls, text: str, limit: int, cursor: str = None, query=None):
+        """Returns one page of the Products whose name matches a search
+
+        Every word of the text must start a word of the name, so "blu sh"
+        finds "Blue Shirt". Results are ranked best first with the id as a
+        tie breaker, and paged with a cursor like paginate(). PostgreSQL uses
+        the GIN index on the name's tsvector; other databases use the
+        in-process search index.
+
+        :param text: the words to search for
+        :type text: str
+        :param limit: the maximum number of Products to return
+        :type limit: int
+        :param cursor: the opaque cursor returned with the previous page
+        :type cursor: str
+        :param query: a select_fields() query to search within, e.g. over
+            find_by_filters(); it must load the id
+        :return: the rows in the page and the cursor for the next page
+            (None when there are no more matches)
+        :rtype: tuple
+        """
+        logger.info("Processing search query %r limit=%s ...", text, limit)
+        terms = tokenize(text)
+        last = cls.decode_cursor(cursor, cls.SEARCH_SORT) if cursor else None
+        if query is None:
+            query = cls.select_fields(cls.FIELDS)
+        if not terms:
+            return [], None
+        if db.engine.dialect.name == "postgresql":
+            ranked = cls._search_postgres(terms, limit, last, query)
+        else:
+            ranked = cls._search_index(text, limit, last, query)
+        if len(ranked) <= limit:
+            return [row for _, row in ranked], None
+        ranked = ranked[:limit]
+        rank, row = ranked[-1]
+        return [row for _, row in ranked], cls.encode_cursor(cls.SEARCH_SORT, rank, row.id)
+
+    @classmethod
+    def _search_postgres(cls, terms, limit, last, query) -> list:
+        """Returns up to limit + 1 (rank, row) matches using full-text search"""
+        vector = db.func.to_tsvector(SEARCH_CONFIG, cls.name)
+        tsquery = db.func.to_tsquery(SEARCH_CONFIG, " & ".join(term + ":*" for term in terms))
+        rank = db.func.ts_rank(vector, tsquery)
+        query = query.filter(vector.op("@@")(tsquery))
+        if last:
+            value, last_id = last
+            query = query.filter(db.or_(rank < value, db.and_(rank == value, cls.id > last_id)))
+        # the rank is added as the last column, after the loaded fields
+        rows = query.add_columns(rank).order_by(rank.desc(), cls.id.asc()).limit(limit + 1)
+        return [(row[-1], row) for row in rows]
+
+    @classmethod
+    def _search_index(cls, text, limit, last, query) -> list:
+        """Returns up to limit + 1 (rank, row) matches using the search index"""
+        if not search_index.loaded:
+            search_index.load(db.session.query(cls.id, cls.name).yield_per(BULK_CHUNK_SIZE))
+        ranked = search_index.search(text)
+        if last:
+            value, last_id = last
+            ranked = [match for match in ranked if (-match[0], match[1]) > (-value, last_id)]
+        # look the candidates up best first, in growing chunks, until the
+        # page is full; the other filters of the query may reject some
+        results = []
+        start, size = 0, limit + 1
+        while start < len(ranked) and len(results) <= limit:
+            chunk = ranked[start:start + size]
+            rows = {row.id: row for row in query.filter(cls.id.in_([match[1] for match in chunk]))}
+            results += [(rank, rows[product_id]) for rank, product_id in chunk if product_id in rows]
+            start += size
+            size = min(size * 2, BULK_CHUNK_SIZE)
+        return results[:limit + 1]
+
+    @classmethod
+    def facets(cls) -> dict:
+        """Returns the Product counts and price statistics per category
+
+        The summary is loaded with a single GROUP BY and then kept current
+        by the change listeners, so reading it never scans the table
+        """
+        if not facet_summary.is_current():
+            logger.info("Processing facet query ...")
+            facet_summary.load(cls.facet_query())
+        return facet_summary.summary()
+
+    @classmethod
+    def facet_query(cls):
+        """Returns the aggregates of each category, availability and price bucket"""
+        bounds = facet_summary.bounds
+        bucket = db.case(
+            *[(cls.price <= bound, index) for index, bound in enumerate(bounds)],
+            else_=len(bounds),
+        )
+        return db.session.query(
+            cls.category,
+            cls.available,
+            bucket,
+            db.func.count(cls.id),
+            db.func.min(cls.price),
+            db.func.max(cls.price),
+            db.func.sum(cls.price),
+        ).group_by(cls.category, cls.available, bucket)
+
+    @classmethod
+    def changes(cls, since: int = 0, limit: int = 100, cursor: str = None):
+        """Returns the Products changed or deleted after a checkpoint
+
+        Every write numbers its rows with the change sequence and every
+        delete leaves a tombstone, so a sync reads one index range scan of
+        each table and costs O(changes) instead of O(catalog). A sequence
+        number that is drawn before an earlier one commits becomes visible
+        later, so consumers on PostgreSQL must re-read a margin before their
+        checkpoint (see the /products/changes route); replaying a change is
+        harmless.
+
+        :param since: the checkpoint, only later changes are returned
+        :type since: int
+        :param limit: the maximum number of changes to return
+        :type limit: int
+        :param cursor: the opaque cursor returned with the previous page
+        :type cursor: str
+        :return: the changes in sequence order, the cursor of the next page
+            (None when caught up) and the checkpoint to resume from, which
+            covers every change up to it
+        :rtype: tuple
+        """
+        logger.info("Processing change query since=%s limit=%s ...", since, limit)
+        last_seq, last_id = cls.decode_cursor(cursor, "change_seq") if cursor else (since, None)
+        if not isinstance(last_seq, int):
+            raise DataValidationError("Invalid cursor: " + cursor)
+        columns = [getattr(cls, field) for field in cls.FIELDS]
+        products = db.session.query(*columns, cls.updated_at, cls.change_seq)
+        products = products.filter(cls.after_change(cls.change_seq, cls.id, last_seq, last_id))
+        products = products.order_by(cls.change_seq, cls.id).limit(limit + 1)
+        tombstone = ProductTombstone
+        deletes = db.session.query(
+            tombstone.product_id, tombstone.sku, tombstone.deleted_at, tombstone.change_seq
+        )
+        deletes = deletes.filter(
+            cls.after_change(tombstone.change_seq, tombstone.product_id, last_seq, last_id)
+        )
+        deletes = deletes.order_by(tombstone.change_seq, tombstone.product_id).limit(limit + 1)
+
+        changes = [
+            {
+                "seq": row.change_seq,
+                "id": row.id,
+                "deleted": False,
+                "updated_at": row.updated_at.isoformat() + "Z",
+                "product": cls.serialize_fields(row, cls.FIELDS),
+            }
+            for row in products
+        ]
+        changes += [
+            {
+                "seq": row.change_seq,
+                "id": row.product_id,
+                "deleted": True,
+                "updated_at": row.deleted_at.isoformat() + "Z",
+                "product": None,
+                "sku": row.sku,
+            }
+            for row in deletes
+        ]
+        changes.sort(key=lambda change: (change["seq"], change["id"], change["deleted"]))
+        if len(changes) <= limit:
+            checkpoint = changes[-1]["seq"] if changes else last_seq
+            return changes, None, checkpoint
+        following = changes[limit]
+        changes = changes[:limit]
+        last = changes[-1]
+        # rows written by one statement may share a number (see next_change_seq)
+        checkpoint = last["seq"] if following["seq"] > last["seq"] else last["seq"] - 1
+        return changes, cls.encode_cursor("change_seq", last["seq"], last["id"]), checkpoint
+
+    @staticmethod
+    def after_change(seq_column, id_column, last_seq: int, last_id: int = None):
+        """Returns the criterion for the changes after a position in the feed"""
+        if last_id is None:
+            return seq_column > last_seq
+        return db.or_(seq_column > last_seq, db.and_(seq_column == last_seq, id_column > last_id))
+
+    @staticmethod
+    def encode_cursor(sort: str, value, last_id: int) -> str:
+        """Encodes the position after a row into an opaque cursor"""
+        payload = json.dumps({"s": sort, "k": [value, last_id]})
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(cursor: str, sort: str):
+        """Decodes a cursor, checking that it was issued for the same sort key
+
+        The values are checked against the types of their columns, so a
+        forged cursor is rejected instead of failing in the database
+        """
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+            value, last_id = payload["k"]
+            if payload["s"] != sort:
+                raise ValueError(sort)
+            expected = Product.CURSOR_TYPES[sort.lstrip("-")]
+            for item, kind in ((value, expected), (last_id, int)):
+                if isinstance(item, bool) or not isinstance(item, kind):
+                    raise TypeError(item)
+        except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+            raise DataValidationError("Invalid cursor: " + cursor)
+        return value, last_id
+
+
+# Full-text index behind Product.search() on PostgreSQL; the expression
+# must match the one _search_postgres() filters on
+SEARCH_INDEX = db.DDL(
+    "CREATE INDEX IF NOT EXISTS ix_product_name_search "
+    "ON %(table)s USING gin (to_tsvector('simple', name))"
+)
+db.event.listen(
+    Product.__table__, "after_create", SEARCH_INDEX.execute_if(dialect="postgresql")
+)
+
+@db.event.listens_for(Product, "after_delete")
+def add_tombstone(mapper, connection, target):  # pylint: disable=unused-argument
+    """Records a Product deleted through the session for the change feed"""
+    connection.execute(
+        ProductTombstone.__table__.insert().values(product_id=target.id, sku=target.sku)
+    )
+
+
+Product.add_listener(product_cache.on_product_change)
+Product.add_listener(search_index.on_product_change)
+Product.add_listener(facet_summary.on_product_change)
+Product.add_listener(event_broker.on_product_change)
@@ -0,0 +1,70 @@
+"""
+Connection Pool
+
+A QueuePool that also counts how often requests had to wait for a
+connection, and a helper that reports the pool statistics so gunicorn
+workers can be sized against the pool.
+"""
+import time
+import logging
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records waits and timeouts on checkout"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        # every pooled and overflow connection is in use, so this will block
+        exhausted = (
+            self._max_overflow > -1
+            and self.checkedout() >= self.size() + self._max_overflow
+        )
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            logger.warning("Timed out waiting for a database connection")
+            raise
+        finally:
+            if exhausted:
+                self.waits += 1
+                self.wait_time += time.perf_counter() - start
+
+
+def init_pool(app):
+    """Uses the instrumented pool when the engine options configure pooling"""
+    options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+    if "pool_size" in options:
+        options.setdefault("poolclass", InstrumentedQueuePool)
+
+
+def pool_stats(engine) -> dict:
+    """Returns the statistics of an engine's connection pool"""
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__, "status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,  # pylint: disable=protected-access
+            timeout=pool.timeout(),
+        )
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(
+            waits=pool.waits,
+            wait_time=round(pool.wait_time, 6),
+            timeouts=pool.timeouts,
+        )
+    return stats
@@ -0,0 +1,150 @@
+"""
+Module: query_detector
+
+Opt-in N+1 and slow query detector for development, staging and tests.
+When QUERY_DETECTOR_ENABLED is set, every request is checked against
+
+* the query budget declared on its route with @query_budget(n), or
+  QUERY_DETECTOR_MAX_STATEMENTS when it has none; batch routes declare it
+  per so many posted items, as they work in chunks,
+* QUERY_DETECTOR_SLOW_MS for any single statement, and
+* QUERY_DETECTOR_REPEAT for the same SELECT run over and over, which is
+  the signature of an N+1 loop.
+
+A run of the same INSERT, UPDATE or DELETE, e.g. the one row at a time
+INSERTs of a flush on SQLite, counts as a single statement: it is one
+batch the unit of work could not send as an executemany.
+
+Violations are logged with the offending SQL and its EXPLAIN plan. With
+QUERY_DETECTOR_RAISE set they raise QueryBudgetExceeded instead, which
+fails the test that made the request.
+"""
+import math
+from collections import Counter
+from flask import g, request
+from . import app
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised when a request breaks its query budget in raise mode"""
+
+
+def query_budget(max_statements: int, per_items: int = None):
+    """Declares the most SQL statements a route may issue per request
+
+    With per_items the budget is for every per_items items of the posted
+    list, and a SELECT may also repeat once per chunk of that size
+    """
+
+    def decorator(func):
+        func.query_budget = max_statements
+        func.query_budget_items = per_items
+        return func
+
+    return decorator
+
+
+def is_write(statement: str) -> bool:
+    """Returns True for INSERT, UPDATE and DELETE statements"""
+    return statement.lstrip().split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE")
+
+
+def collapse_writes(statements) -> list:
+    """Merges each run of the same write statement into its first one"""
+    collapsed = []
+    for item in statements:
+        if collapsed and is_write(item[0]) and collapsed[-1][0] == item[0]:
+            continue
+        collapsed.append(item)
+    return collapsed
+
+
+def find_violations(statements, budget: int, slow_ms: float, repeat: int) -> list:
+    """Returns a description of every problem in a list of statements
+
+    Args:
+        statements (list): (statement, parameters, duration) tuples
+        budget (int): the most statements allowed
+        slow_ms (float): the duration in milliseconds of a slow statement
+        repeat (int): how often the same SQL may run before it is an N+1
+    """
+    violations = []
+    batches = collapse_writes(statements)
+    if len(batches) > budget:
+        slowest = max(statements, key=lambda item: item[2])
+        violations.append(
+            (
+                "budget",
+                "{} statements exceed the budget of {}".format(len(batches), budget),
+                slowest[:2],
+            )
+        )
+    for statement, parameters, duration in statements:
+        if duration * 1000 > slow_ms:
+            violations.append(
+                ("slow", "statement took {:.1f} ms".format(duration * 1000), (statement, parameters))
+            )
+    counts = Counter(statement for statement, _, _ in statements if not is_write(statement))
+    for statement, count in counts.items():
+        if count > repeat:
+            parameters = next(params for sql, params, _ in statements if sql == statement)
+            violations.append(
+                ("repeat", "same statement ran {} times (N+1?)".format(count), (statement, parameters))
+            )
+    return violations
+
+
+def explain(statement: str, parameters) -> str:
+    """Returns the query plan of a statement, or why there is none"""
+    # imported here because the models import this package
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    engine = db.get_engine()
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    try:
+        with engine.connect() as conn:
+            rows = conn.exec_driver_sql(prefix + statement, parameters or ())
+            return "\n".join(" ".join(str(column) for column in row) for row in rows)
+    except Exception as error:  # pylint: disable=broad-except
+        return "EXPLAIN failed: {}".format(error)
+
+
+######################################################################
+# Flask request hooks
+######################################################################
+@app.after_request
+def check_query_budget(response):
+    """Logs or raises for the requests that break their query budget"""
+    metrics = g.get("request_metrics")
+    if not app.config.get("QUERY_DETECTOR_ENABLED") or metrics is None or metrics.statements is None:
+        return response
+    view = app.view_functions.get(request.endpoint)
+    budget = getattr(view, "query_budget", app.config.get("QUERY_DETECTOR_MAX_STATEMENTS", 10))
+    repeat = app.config.get("QUERY_DETECTOR_REPEAT", 3)
+    per_items = getattr(view, "query_budget_items", None)
+    items = request.get_json(silent=True) if per_items else None
+    if isinstance(items, list):
+        chunks = max(math.ceil(len(items) / per_items), 1)
+        budget *= chunks
+        repeat *= chunks
+    statements = list(metrics.statements)
+    violations = find_violations(
+        statements, budget, app.config.get("QUERY_DETECTOR_SLOW_MS", 100), repeat
+    )
+    if not violations:
+        return response
+
+    lines = ["{} {} ({}): query problems detected".format(request.method, request.path, request.endpoint)]
+    for kind, message, offender in violations:
+        lines.append("  [{}] {}".format(kind, message))
+        if offender:
+            lines.append("    SQL: {}".format(offender[0]))
+            lines.append("    PLAN: {}".format(explain(*offender).replace("\n", "\n          ")))
+    if any(kind == "budget" for kind, _, _ in violations):
+        lines.append("  statements:")
+        lines += ["    {:.1f} ms  {}".format(duration * 1000, sql) for sql, _, duration in statements]
+    report = "\n".join(lines)
+    if app.config.get("QUERY_DETECTOR_RAISE"):
+        raise QueryBudgetExceeded(report)
+    app.logger.warning(report)
+    return response
@@ -0,0 +1,232 @@
+"""
+Read Replicas
+
+Routes the read-only Product queries to read replicas. Queries built by
+Product.replica_query() (Product.all(), find(), the find_by_*() filters
+and query_by_price()) carry the "replica" execution option, and the
+RoutingSession sends them to the next healthy replica in round-robin
+order. Everything else goes to the primary:
+
+* every statement that is not a marked SELECT, including flushes and the
+  reloads that follow a commit,
+* every query of a session that has written, and
+* every query of a request that is not a GET or HEAD, or whose client
+  wrote within the last REPLICA_STICKY_SECONDS (read-your-writes, tracked
+  with a cookie set on the responses to writes).
+
+A replica is checked with SELECT 1 at most every REPLICA_CHECK_INTERVAL
+seconds and skipped while it is down, or after a query on it fails with a
+connection error. With no healthy replica, reads fall back to the primary.
+"""
+import time
+import logging
+import threading
+from flask import request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, text
+from sqlalchemy.sql import Select
+from . import app
+
+logger = logging.getLogger("flask.app")
+
+# Execution option of the queries that a replica may answer
+REPLICA_OPTION = "replica"
+
+# Cookie that keeps a client on the primary for a while after it writes
+STICKY_COOKIE = "db-primary"
+
+# Session.info key of sessions that must only use the primary
+PRIMARY_ONLY = "primary_only"
+
+# Methods whose requests may read from a replica
+READ_METHODS = ("GET", "HEAD")
+
+
+class Replica:
+    """A read replica engine and its health"""
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+        self.queries = 0
+        self.failures = 0
+        event.listen(engine, "handle_error", self.on_error)
+
+    def check(self):
+        """Runs SELECT 1 on the replica and records whether it answered"""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        except Exception as error:  # pylint: disable=broad-except
+            self.mark_down(error)
+        else:
+            if not self.healthy:
+                logger.info("Read replica %s is back", self.name)
+            self.healthy = True
+
+    def mark_down(self, error):
+        """Stops using the replica until its next health check"""
+        if self.healthy:
+            logger.warning("Read replica %s is down: %s", self.name, error)
+        self.healthy = False
+        self.failures += 1
+
+    def on_error(self, context):
+        """Engine error hook that takes the replica out on connection errors"""
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.original_exception)
+
+
+class ReplicaRouter:
+    """Picks a healthy read replica in round-robin order"""
+
+    def __init__(self, check_interval: float = 30, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.clock = clock
+        self.replicas = []
+        self.fallbacks = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Returns True when replicas are configured"""
+        return bool(self.replicas)
+
+    def configure(self, replicas: list, check_interval: float):
+        """Replaces the replicas"""
+        with self._lock:
+            self.replicas = list(replicas)
+            self.check_interval = check_interval
+            self._next = 0
+
+    def pick(self):
+        """Returns the engine of the next healthy replica, or None for the primary"""
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+                due = replica.checked_at is None or self.clock() - replica.checked_at >= self.check_interval
+                if due:
+                    replica.checked_at = self.clock()
+            if due:
+                replica.check()
+            if replica.healthy:
+                replica.queries += 1
+                return replica.engine
+        self.fallbacks += 1
+        return None
+
+    def stats(self) -> dict:
+        """Returns the health and query counts of each replica"""
+        return {
+            "replicas": [
+                {
+                    "name": replica.name,
+                    "healthy": replica.healthy,
+                    "queries": replica.queries,
+                    "failures": replica.failures,
+                }
+                for replica in self.replicas
+            ],
+            "fallbacks": self.fallbacks,
+        }
+
+
+# The replicas of this process, configured in init_replicas()
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends marked read-only queries to a read replica"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):  # pylint: disable=arguments-differ
+        if (
+            replica_router.enabled
+            and isinstance(clause, Select)
+            and clause.get_execution_options().get(REPLICA_OPTION)
+            and not self.info.get(PRIMARY_ONLY)
+            and not self._flushing
+        ):
+            engine = replica_router.pick()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions route reads to the read replicas"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def pin_to_primary(session):
+    """Sends every later query of a session to the primary"""
+    session.info[PRIMARY_ONLY] = True
+
+
+def init_replicas(app_, db):
+    """Builds the replica engines from REPLICA_DATABASE_URIS
+
+    Each replica is a Flask-SQLAlchemy bind named replica_<n>. No model
+    uses these binds, so they never get tables of their own.
+    """
+    binds = {
+        key: uri
+        for key, uri in (app_.config.get("SQLALCHEMY_BINDS") or {}).items()
+        if not key.startswith("replica_")
+    }
+    names = []
+    for index, uri in enumerate(app_.config["REPLICA_DATABASE_URIS"]):
+        names.append("replica_{}".format(index))
+        binds[names[-1]] = uri
+    app_.config["SQLALCHEMY_BINDS"] = binds
+    replicas = [Replica(name, db.get_engine(app_, bind=name)) for name in names]
+    replica_router.configure(replicas, app_.config["REPLICA_CHECK_INTERVAL"])
+    if replicas:
+        logger.info("Reading from %d replicas", len(replicas))
+
+
+######################################################################
+# Flask request hooks
+######################################################################
+@app.before_request
+def route_request():
+    """Keeps writes, and the reads that follow them, on the primary"""
+    if not replica_router.enabled:
+        return
+    # imported here because the models import this module
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    if request.method not in READ_METHODS or request.cookies.get(STICKY_COOKIE):
+        pin_to_primary(db.session)
+
+
+@app.after_request
+def set_sticky_cookie(response):
+    """Sends the client's reads to the primary for a while after it writes"""
+    if replica_router.enabled and request.method not in READ_METHODS and response.status_code < 400:
+        response.set_cookie(
+            STICKY_COOKIE,
+            "1",
+            max_age=app.config["REPLICA_STICKY_SECONDS"],
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def pin_after_flush(session, flush_context):  # pylint: disable=unused-argument
+    """Reads in a session that has written must see its own writes"""
+    pin_to_primary(session)
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def pin_after_write(orm_execute_state):
+    """Pins the sessions that run INSERT, UPDATE or DELETE statements"""
+    if not orm_execute_state.is_select:
+        pin_to_primary(orm_execute_state.session)
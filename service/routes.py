@@ -4,15 +4,62 @@ Product Service
 Paths:
 ------
 GET /products - Returns a list all of the Products
+GET /products?category=&name=&available=&minimum=&maximum= - Returns the
+    Products that match all of the given filters; either end of the price
+    range may be left open
+GET /products?limit={n}&cursor={cursor} - Returns one page of Products
+GET /products?sort=-price - Returns the Products ordered by id, name,
+    category or price, '-' for descending (also with limit and cursor)
+GET /products?fields=id,price - Returns only the given fields of each Product
+GET /products?q={words} - Returns the Products whose names match a prefix
+    search, best match first, one page at a time
+GET /products?stream=1 - Streams all of the Products as a chunked JSON list
+GET /products (Accept: application/x-ndjson) - Streams Products as NDJSON
 GET /products/{id} - Returns the Product with a given id number
+GET /products/facets - Returns the Product counts, price ranges and price
+    histograms of each category
+GET /products/changes?since={seq} - Returns the Products changed or deleted
+    after a checkpoint, in change order, one page at a time
+GET /products/events?types=enable,disable - Streams Product changes as
+    Server-Sent Events (create, update, delete, enable, disable, reset)
 POST /products - creates a new Product record in the database
 PUT /products/{id} - updates a Product record in the database
 DELETE /products/{id} - deletes a Product record in the database
+POST /products:batch - creates a list of Products in one transaction
+PUT /products:batch - updates a list of Products in one transaction
+PUT /products/sku/{sku} - creates or updates the Product with a given sku
+PUT /products:upsert - creates or updates a list of Products by sku
+DELETE /products - deletes the Products that match the query string
+    filters, or every Product with ?all=true
+
+GET requests return an ETag and honor If-None-Match with 304 Not Modified,
+PUT /products/{id} honors If-Match with 412 Precondition Failed
+
+Responses over COMPRESSION_MIN_SIZE bytes, and streams, are compressed
+with zstd, br or gzip as Accept-Encoding allows; see service/compression.py
+
+With WRITE_BEHIND_ENABLED, PUT /products/{id} without If-Match queues the
+update and returns 202 Accepted; see service/write_behind.py
+
+GET /internal/cache - Returns the product cache statistics
+GET /internal/pool - Returns the database connection pool statistics
+GET /internal/events - Returns the event stream subscriber counts
+GET /internal/compression - Returns the compressed body cache statistics
+GET /internal/replicas - Returns the health and query counts of the read
+    replicas (see service/replicas.py)
+GET /internal/write-behind - Returns the write-behind queue status; queued
+    updates are written once their seq is at most flushed_seq
+POST /internal/write-behind:flush - Writes the queued updates now
+GET /metrics - Returns request latency, SQL and cache metrics for Prometheus
 
 Actions:
 
 PUT /products/{id}/disable - Disable a product 
 PUT /products/{id}/enable - Enable of a product
+PUT /products:disable - Disable the Products given by {"ids": [...]} and/or
+    the query string filters (or ?all=true), in one statement
+PUT /products:enable - Enable the Products given by {"ids": [...]} and/or
+    the query string filters (or ?all=true), in one statement
 
 """
 
@@ -20,10 +67,23 @@ from itertools import product
 import os
 import sys
 import logging
+import hashlib
+from decimal import Decimal, InvalidOperation
 from flask import Flask, jsonify, request, url_for, make_response, abort
-from werkzeug.exceptions import NotFound
-from service.models import Product, DataValidationError
+from flask import Response, stream_with_context
+from werkzeug.exceptions import NotFound, PreconditionFailed, ServiceUnavailable
+from service.models import Product, DataValidationError, DataStaleError, db, BULK_CHUNK_SIZE
+from service.cache import product_cache
+from service.pool import pool_stats
+from service.write_behind import write_behind
+from service.replicas import replica_router
+from service.events import event_broker, format_event, EVENT_TYPES, RETRY_MS
 from . import status  # HTTP Status Codes
+from . import fastjson
+from . import instrumentation
+from .query_detector import query_budget
+# registered after the hooks above so they see the compressed response
+from .compression import compressed_bodies, init_compression, available_encodings
 from . import app  # Import Flask application
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
@@ -52,6 +112,7 @@ def index():
 # CREATE A NEW PRODUCT
 ######################################################################
 @app.route("/products", methods=["POST"])
+@query_budget(2)
 def create_products():
     """
     Creates a Product
@@ -74,24 +135,27 @@ def create_products():
 # READ A PRODUCT 
 ######################################################################
 @app.route("/products/<int:product_id>", methods=["GET"])
+@query_budget(1)
 def get_products(product_id):
     """
     Retrieve a single Product
     This endpoint will return a Product based on its id
     """
     app.logger.info("Request for product with id: %s", product_id)
-    product = Product.find(product_id)
-    if not product:
+    data = Product.find_serialized(product_id)
+    if not data:
         raise NotFound("Product with id '{}' was not found.".format(product_id))
 
-    app.logger.info("Returning product: %s", product.name)
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    app.logger.info("Returning product: %s", data["name"])
+    return conditional_response(data)
 
 
 ######################################################################
 # UPDATE AN EXISTING PRODUCT
 ######################################################################
 @app.route("/products/<int:product_id>", methods=["PUT"])
+# the read, the claim of an If-Match update, the UPDATE and the row read back
+@query_budget(4)
 def update_products(product_id):
     """
     Update a Product
@@ -99,47 +163,324 @@ def update_products(product_id):
     """
     app.logger.info("Request to update product with id: %s", product_id)
     check_content_type("application/json")
+    if app.config.get("WRITE_BEHIND_ENABLED") and not request.if_match:
+        return queue_update(product_id)
     product = Product.find(product_id)
     if not product:
         raise NotFound("Product with id '{}' was not found.".format(product_id))
+    # compressed responses carry the ETag as a weak one, the hash of the
+    # same JSON, so it is compared weakly
+    if request.if_match and not request.if_match.contains_weak(make_etag(product.serialize())):
+        raise PreconditionFailed(
+            "Product with id '{}' was modified by another request.".format(product_id)
+        )
+    expected_seq = product.change_seq if request.if_match else None
     product.deserialize(request.get_json())
     product.id = product_id
-    product.update()
+    try:
+        product.update(expected_seq)
+    except DataStaleError as error:
+        raise PreconditionFailed(str(error))
 
     app.logger.info("Product with ID [%s] updated.", product.id)
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    data = product.serialize()
+    response = make_response(jsonify(data), status.HTTP_200_OK)
+    response.set_etag(make_etag(data))
+    return response
+
+def queue_update(product_id):
+    """Validates an update and queues it for the next write-behind flush"""
+    data = request.get_json()
+    # check the body now, the flush only reports errors in the status
+    Product().deserialize(data)
+    seq = write_behind.submit(product_id, data)
+    app.logger.info("Product with ID [%s] update queued as %s.", product_id, seq)
+    location_url = url_for("write_behind_status", _external=True)
+    return make_response(
+        jsonify(id=product_id, seq=seq, status="queued"),
+        status.HTTP_202_ACCEPTED,
+        {"Location": location_url},
+    )
+
 
 ######################################################################
 # LIST ALL PRODUCTS
 ######################################################################
 
 @app.route("/products", methods=["GET"])
+# a search may also load the search index and look candidates up in chunks
+@query_budget(3)
 def list_products():
-    """Returns all of the Products"""
+    """Returns all of the Products
+
+    When a limit is given only one page of Products is returned, and the
+    Link header carries the URL of the next page. Full exports can instead
+    be streamed with ?stream=1 or Accept: application/x-ndjson, and ?q=
+    returns ranked search results one page at a time
+    """
     app.logger.info("Request for product list")
-    products = []
-    category = request.args.get("category")
-    name = request.args.get("name")
-    minimum = request.args.get("minimum")
-    maximum = request.args.get("maximum")
-    if category:
-        products = Product.find_by_category(category)
-    elif name:
-        products = Product.find_by_name(name)
-    elif minimum and maximum:
-        products = Product.query_by_price(minimum, maximum)
-    else:
-        products = Product.all()
+    limit = request.args.get("limit")
+    sort = request.args.get("sort") or "id"
+    Product.sort_order(sort)  # reject bad keys before any streaming starts
+    fields = parse_fields(request.args.get("fields")) or list(Product.FIELDS)
+    # pagination needs the id and the sort key to build the next cursor
+    loaded = fields + [key for key in ("id", sort.lstrip("-")) if key not in fields]
+    # rows are plain tuples, so no Product objects are built for the list;
+    # find_by_filters() with no filters still reads from a replica
+    query = Product.select_fields(loaded, filter_query() or Product.find_by_filters())
+    serialize = lambda row: Product.serialize_fields(row, fields)
+    search = request.args.get("q")
 
-    results = [product.serialize() for product in products]
-    app.logger.info("Returning %d products", len(results))
+    if search:
+        if "sort" in request.args:
+            raise DataValidationError("Invalid sort: search results are ordered by rank")
+        limit = parse_limit(limit) if limit is not None else app.config["SEARCH_PAGE_SIZE"]
+        with instrumentation.timer("fetch"):
+            products, next_cursor = Product.search(
+                search, limit, request.args.get("cursor"), query=query
+            )
+        return page_response(products, next_cursor, serialize)
+    if "cursor" in request.args and limit is None:
+        # the catalog would otherwise come back whole, ignoring the cursor
+        raise DataValidationError("Invalid cursor: a cursor needs a limit")
+    if wants_ndjson():
+        return Response(
+            stream_with_context(generate_ndjson(query, serialize, sort)), mimetype=NDJSON
+        )
+    if request.args.get("stream") in ("1", "true"):
+        return Response(
+            stream_with_context(generate_json_list(query, serialize, sort)),
+            mimetype="application/json",
+        )
+
+    next_cursor = None
+    with instrumentation.timer("fetch"):
+        if limit is not None:
+            products, next_cursor = Product.paginate(
+                parse_limit(limit), request.args.get("cursor"), sort, query
+            )
+        else:
+            products = query.order_by(*Product.sort_order(sort)).all()
+    return page_response(products, next_cursor, serialize)
+
+
+######################################################################
+# PRODUCT FACETS
+######################################################################
+@app.route("/products/facets", methods=["GET"])
+@query_budget(1)
+def product_facets():
+    """Returns the counts and price statistics of each category
+
+    The summary is maintained as Products change, so this does not scan
+    the catalog
+    """
+    app.logger.info("Request for product facets")
+    with instrumentation.timer("fetch"):
+        facets = Product.facets()
+    return conditional_response(facets)
+
+
+######################################################################
+# PRODUCT CHANGE FEED
+######################################################################
+@app.route("/products/changes", methods=["GET"])
+@query_budget(2)
+def product_changes():
+    """Returns the Products changed or deleted since a checkpoint
+
+    Deleted Products come back with "deleted": true and no product. The
+    response carries the checkpoint to send as ?since= on the next sync,
+    and a Link header to the next page while there are more changes.
+
+    On PostgreSQL a write draws its sequence number before it commits, so
+    a slow transaction can commit a number below a checkpoint that was
+    already returned. Consumers must resume from the checkpoint minus a
+    re-read margin of at least the number of changes written while the
+    longest write transaction is open (e.g. 1000 for 1000 writes/s and
+    transactions under a second), and skip the (seq, id) pairs they have
+    applied. SQLite runs one write at a time and needs no margin
+    """
+    app.logger.info("Request for product changes")
+    since = parse_since(request.args.get("since"))
+    limit = request.args.get("limit")
+    limit = parse_limit(limit) if limit is not None else app.config["CHANGES_PAGE_SIZE"]
+    with instrumentation.timer("fetch"):
+        changes, next_cursor, checkpoint = Product.changes(
+            since, limit, request.args.get("cursor")
+        )
+    headers = {}
+    if next_cursor:
+        args = request.args.to_dict()
+        args["cursor"] = next_cursor
+        next_url = url_for("product_changes", _external=True, **args)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    app.logger.info("Returning %d changes", len(changes))
+    return conditional_response({"changes": changes, "checkpoint": checkpoint}, headers)
+
+
+######################################################################
+# PRODUCT EVENTS
+######################################################################
+@app.route("/products/events", methods=["GET"])
+@query_budget(0)
+def product_events():
+    """Streams Product changes as Server-Sent Events
+
+    A client that reconnects with Last-Event-ID gets the events it missed,
+    or a "reset" event when it should resync from /products/changes
+    """
+    app.logger.info("Request for product events")
+    types = request.args.get("types")
+    if types:
+        types = types.split(",")
+        unknown = [kind for kind in types if kind not in EVENT_TYPES]
+        if unknown:
+            raise DataValidationError("Invalid types: " + ", ".join(unknown))
+    last_event_id = request.headers.get("Last-Event-ID")
+    last_event_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+    subscription = event_broker.subscribe(types, last_event_id)
+    if subscription is None:
+        raise ServiceUnavailable("Too many event streams are open, try again later.")
+    return Response(
+        generate_events(subscription, app.config["EVENTS_HEARTBEAT"]),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def generate_events(subscription, heartbeat: float):
+    """Yields the events of a subscription, with keep-alive comments in between"""
+    try:
+        yield b"retry: %d\n\n" % RETRY_MS
+        while not subscription.closed:
+            event = subscription.get(heartbeat)
+            # the comment also tells a disconnected client apart
+            yield b": keep-alive\n\n" if event is None else format_event(event)
+    finally:
+        event_broker.unsubscribe(subscription)
+
+
+######################################################################
+# CREATE MANY PRODUCTS
+######################################################################
+@app.route("/products:batch", methods=["POST"])
+# the INSERTs of the flush, then the rows read back in chunks
+@query_budget(2, per_items=BULK_CHUNK_SIZE)
+def create_products_batch():
+    """
+    Creates many Products
+    This endpoint will create every Product in the posted list in one transaction
+    """
+    app.logger.info("Request to create a batch of products")
+    items = get_batch()
+    products, errors = Product.bulk_create(items)
+    app.logger.info("Created %d products, %d errors", len(products), len(errors))
+    results = {"products": products, "errors": errors}
+    if errors and not products:
+        return make_response(jsonify(results), status.HTTP_400_BAD_REQUEST)
+    return make_response(jsonify(results), status.HTTP_201_CREATED)
+
+
+######################################################################
+# UPDATE MANY PRODUCTS
+######################################################################
+@app.route("/products:batch", methods=["PUT"])
+# the stored rows, one executemany UPDATE and the rows read back, in chunks
+@query_budget(3, per_items=BULK_CHUNK_SIZE)
+def update_products_batch():
+    """
+    Updates many Products
+    This endpoint will update every Product in the posted list in one transaction
+    """
+    app.logger.info("Request to update a batch of products")
+    items = get_batch()
+    products, errors = Product.bulk_update(items)
+    app.logger.info("Updated %d products, %d errors", len(products), len(errors))
+    results = {"products": products, "errors": errors}
+    if errors and not products:
+        return make_response(jsonify(results), status.HTTP_400_BAD_REQUEST)
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+
+######################################################################
+# CREATE OR UPDATE A PRODUCT BY SKU
+######################################################################
+@app.route("/products/sku/<string:sku>", methods=["PUT"])
+@query_budget(3)
+def upsert_product(sku):
+    """
+    Creates or updates the Product with a sku
+    This endpoint is idempotent, so an upstream sync can safely retry it
+    """
+    app.logger.info("Request to upsert product with sku: %s", sku)
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid Product: body of request contained bad or no data")
+    saved, errors = Product.upsert([dict(data, sku=sku)])
+    if errors:
+        raise DataValidationError(errors[0]["error"])
+    product, created = saved[0]
+    if not created:
+        app.logger.info("Product with sku [%s] updated.", sku)
+        return make_response(jsonify(product), status.HTTP_200_OK)
+    app.logger.info("Product with sku [%s] created.", sku)
+    location_url = url_for("get_products", product_id=product["id"], _external=True)
+    return make_response(jsonify(product), status.HTTP_201_CREATED, {"Location": location_url})
+
+
+######################################################################
+# CREATE OR UPDATE MANY PRODUCTS BY SKU
+######################################################################
+@app.route("/products:upsert", methods=["PUT"])
+# SQLite reads, upserts and reads again some 160 rows per statement
+@query_budget(3, per_items=100)
+def upsert_products_batch():
+    """
+    Creates or updates many Products by sku
+    This endpoint writes the whole list with INSERT ... ON CONFLICT statements
+    """
+    app.logger.info("Request to upsert a batch of products")
+    items = get_batch()
+    saved, errors = Product.upsert(items)
+    created = sum(1 for _, was_created in saved if was_created)
+    app.logger.info("Upserted %d products (%d created), %d errors", len(saved), created, len(errors))
+    results = {
+        "products": [product for product, _ in saved],
+        "created": created,
+        "updated": len(saved) - created,
+        "errors": errors,
+    }
+    if errors and not saved:
+        return make_response(jsonify(results), status.HTTP_400_BAD_REQUEST)
     return make_response(jsonify(results), status.HTTP_200_OK)
 
 
+######################################################################
+# DELETE MANY PRODUCTS
+######################################################################
+@app.route("/products", methods=["DELETE"])
+# the tombstones of the deleted Products are written first
+@query_budget(2)
+def delete_products_batch():
+    """
+    Delete many products
+    This endpoint will delete every Product matching the query string filters
+    """
+    app.logger.info("Request to delete products with filters: %s", request.args.to_dict())
+    filters = batch_filter_args()
+    query = None if all(value is None for value in filters.values()) else Product.find_by_filters(**filters)
+    count = Product.bulk_delete(query)
+    app.logger.info("Deleted %d products.", count)
+    return make_response("", status.HTTP_204_NO_CONTENT)
+
+
 ######################################################################
 # DELETE A PRODUCT
 ######################################################################
 @app.route("/products/<int:product_id>", methods=["DELETE"])
+@query_budget(3)
 def delete_products(product_id):
     """
     Delete a product
@@ -154,6 +495,89 @@ def delete_products(product_id):
     return make_response("", status.HTTP_204_NO_CONTENT)
 
 
+######################################################################
+# CACHE STATISTICS
+######################################################################
+@app.route("/internal/cache", methods=["GET"])
+def cache_stats():
+    """Returns the hit and miss counters of the product cache"""
+    return make_response(jsonify(product_cache.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# WRITE-BEHIND QUEUE
+######################################################################
+@app.route("/internal/write-behind", methods=["GET"])
+def write_behind_status():
+    """Returns the counters of the write-behind queue"""
+    return make_response(jsonify(write_behind.status()), status.HTTP_200_OK)
+
+
+@app.route("/internal/write-behind:flush", methods=["POST"])
+def flush_write_behind():
+    """Writes the queued updates without waiting for the next flush"""
+    flushed = write_behind.flush()
+    data = dict(write_behind.status(), written=flushed)
+    return make_response(jsonify(data), status.HTTP_200_OK)
+
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@app.route("/internal/pool", methods=["GET"])
+def connection_pool_stats():
+    """Returns the checked out, overflow and wait counts of the connection pool"""
+    return make_response(jsonify(pool_stats(db.engine)), status.HTTP_200_OK)
+
+
+######################################################################
+# EVENT STREAM STATISTICS
+######################################################################
+@app.route("/internal/events", methods=["GET"])
+def event_stats():
+    """Returns the subscriber and event counters of the event broker"""
+    return make_response(jsonify(event_broker.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# READ REPLICA STATISTICS
+######################################################################
+@app.route("/internal/replicas", methods=["GET"])
+def replica_stats():
+    """Returns the health and query counts of the read replicas"""
+    return make_response(jsonify(replica_router.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# COMPRESSION STATISTICS
+######################################################################
+@app.route("/internal/compression", methods=["GET"])
+def compression_stats():
+    """Returns the counters of the compressed body cache"""
+    data = dict(compressed_bodies.stats(), encodings=available_encodings())
+    return make_response(jsonify(data), status.HTTP_200_OK)
+
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Returns the request, SQL, cache and pool metrics for Prometheus"""
+    gauges = {}
+    for name, value in product_cache.stats().items():
+        if isinstance(value, (int, float)):
+            gauges["product_cache_" + name] = value
+    for name, value in pool_stats(db.engine).items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauges["db_pool_" + name] = value
+    return app.response_class(
+        instrumentation.registry.render(gauges),
+        mimetype="text/plain",
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
@@ -163,6 +587,214 @@ def init_db():
     """ Initializes the SQLAlchemy app """
     global app
     Product.init_db(app)
+    init_compression(app)
+
+
+@app.teardown_request
+def remove_session(exception=None):  # pylint: disable=unused-argument
+    """Returns the request's database connection to the pool
+
+    The main thread keeps the app context pushed in init_db() alive, so
+    without this its session would stay open across requests
+    """
+    db.session.remove()
+
+NDJSON = "application/x-ndjson"
+
+
+def wants_ndjson():
+    """Checks if the client prefers newline delimited JSON"""
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON])
+    return best == NDJSON or request.args.get("stream") == "ndjson"
+
+
+def generate_ndjson(query, serialize=Product.serialize, sort="id"):
+    """Yields one serialized Product per line"""
+    for product in Product.iterate(query, app.config["STREAM_BATCH_SIZE"], sort):
+        yield fastjson.dumps(serialize(product)) + b"\n"
+
+
+def generate_json_list(query, serialize=Product.serialize, sort="id"):
+    """Yields a JSON list of Products one element at a time"""
+    separator = b"["
+    for product in Product.iterate(query, app.config["STREAM_BATCH_SIZE"], sort):
+        yield separator + fastjson.dumps(serialize(product))
+        separator = b","
+    yield b"[]" if separator == b"[" else b"]"
+
+
+def filter_query():
+    """Builds a query from the filters in the query string
+
+    Returns None when no filters were given
+    """
+    filters = filter_args()
+    if all(value is None for value in filters.values()):
+        return None
+    return Product.find_by_filters(**filters)
+
+
+def filter_args():
+    """Returns the filters in the query string, None for those not given"""
+    filters = {
+        "category": request.args.get("category") or None,
+        "name": request.args.get("name") or None,
+        "available": parse_bool(request.args.get("available")),
+        "minimum": parse_price(request.args.get("minimum"), "minimum"),
+        "maximum": parse_price(request.args.get("maximum"), "maximum"),
+    }
+    check_price_range(filters["minimum"], filters["maximum"])
+    return filters
+
+
+# Query string parameters accepted by the writes to many Products
+BATCH_ARGS = ("category", "name", "available", "minimum", "maximum", "all")
+
+
+def batch_filter_args(targeted: bool = False):
+    """Returns the filters of a write to many Products from the query string
+
+    Parameters that are not filters are rejected, so a typo cannot widen the
+    write to the whole catalog. Without filters every Product is written,
+    which must be asked for with ?all=true unless the request picks its
+    Products another way (targeted)
+    """
+    unknown = sorted(set(request.args) - set(BATCH_ARGS))
+    if unknown:
+        raise DataValidationError("Invalid query parameters: " + ", ".join(unknown))
+    filters = filter_args()
+    everything = parse_bool(request.args.get("all"))
+    if not targeted and not everything and all(value is None for value in filters.values()):
+        raise DataValidationError("No filters given: use all=true to change every Product")
+    return filters
+
+
+def page_response(products, next_cursor, serialize):
+    """Returns a list of Products with a Link header to the next page"""
+    headers = {}
+    if next_cursor:
+        args = request.args.to_dict()
+        args["cursor"] = next_cursor
+        next_url = url_for("list_products", _external=True, **args)
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    with instrumentation.timer("serialize"):
+        results = [serialize(product) for product in products]
+    app.logger.info("Returning %d products", len(results))
+    return conditional_response(results, headers)
+
+
+def get_batch():
+    """Returns the list of items posted to a batch endpoint"""
+    check_content_type("application/json")
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise DataValidationError("Invalid batch: body must be a list of Products")
+    max_size = app.config["MAX_BATCH_SIZE"]
+    if len(items) > max_size:
+        raise DataValidationError(
+            "Invalid batch: at most {} Products can be sent at once".format(max_size)
+        )
+    return items
+
+
+def parse_fields(value):
+    """Parses the comma separated list of fields from the query string"""
+    if not value:
+        return None
+    fields = []
+    for field in value.split(","):
+        field = field.strip()
+        if field and field not in fields:
+            fields.append(field)
+    return fields
+
+
+def parse_bool(value):
+    """Parses an optional boolean from the query string"""
+    if value is None or value == "":
+        return None
+    if value.lower() in ("true", "yes", "1"):
+        return True
+    if value.lower() in ("false", "no", "0"):
+        return False
+    raise DataValidationError("Invalid boolean: " + value)
+
+
+def parse_price(value, name="price"):
+    """Parses an optional price bound from the query string
+
+    The text is parsed as a Decimal, so values like "nan", "inf" or "1e999"
+    are rejected instead of silently matching nothing or everything
+    """
+    if value is None or value == "":
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise DataValidationError("Invalid {}: {}".format(name, value))
+    if not price.is_finite() or price < 0 or abs(float(price)) == float("inf"):
+        raise DataValidationError("Invalid {}: {}".format(name, value))
+    # the price column is a float, so the bound is compared as one
+    return float(price)
+
+
+def check_price_range(minimum, maximum):
+    """Checks that a price range is not empty"""
+    if minimum is not None and maximum is not None and minimum > maximum:
+        raise DataValidationError(
+            "Invalid price range: minimum {} is above maximum {}".format(minimum, maximum)
+        )
+
+
+def parse_since(value):
+    """Parses the change feed checkpoint from the query string"""
+    if value is None or value == "":
+        return 0
+    try:
+        since = int(value)
+    except ValueError:
+        raise DataValidationError("Invalid since: " + value)
+    if since < 0:
+        raise DataValidationError("Invalid since: must not be negative")
+    return since
+
+
+def parse_limit(value):
+    """Parses the page size from the query string"""
+    try:
+        limit = int(value)
+    except ValueError:
+        raise DataValidationError("Invalid limit: " + value)
+    max_limit = app.config["MAX_PAGE_SIZE"]
+    if limit < 1 or limit > max_limit:
+        raise DataValidationError(
+            "Invalid limit: must be between 1 and {}".format(max_limit)
+        )
+    return limit
+
+def make_etag(data):
+    """Computes a strong ETag from serialized data"""
+    return hashlib.sha1(fastjson.dumps(data)).hexdigest()
+
+
+def conditional_response(data, headers=None):
+    """Returns the data as JSON, or 304 Not Modified if the client has it
+
+    The body is encoded once and its hash is the ETag. The client's copy is
+    current when its If-None-Match header carries that ETag, in which case
+    the body is not sent
+    """
+    with instrumentation.timer("encode"):
+        body = fastjson.dumps(data)
+        etag = hashlib.sha1(body).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", status.HTTP_304_NOT_MODIFIED, headers)
+    else:
+        response = app.response_class(body, mimetype="application/json")
+        response.headers.extend(headers or {})
+    response.set_etag(etag)
+    return response
+
 
 def check_content_type(media_type):
     """Checks that the media type is correct"""
@@ -179,37 +811,71 @@ def check_content_type(media_type):
 # UPDATE A PRODUCT'S AVAILABILITY to FALSE
 ######################################################################
 @app.route("/products/<int:product_id>/disable", methods=["PUT"])
+@query_budget(2)
 def disable_product(product_id):
     """Update a Product's availability to false
     IRL, this action would also remove the product from shopping carts, tell the warehouse to order more, and/or something similar
     """
     app.logger.info("Request to disable product with id: %s", product_id)
-    check_content_type("application/json")
-    product = Product.find(product_id)
+    product = Product.set_available(product_id, False)
     if not product:
         raise NotFound(
            "Product with id '{}' was not found.".format(product_id))
-    product.deserialize(request.get_json())
-    product.available = False
-    product.update()
-    app.logger.info("Product with ID [%s] disabled.", product.id)
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    app.logger.info("Product with ID [%s] disabled.", product_id)
+    return make_response(jsonify(product), status.HTTP_200_OK)
 ######################################################################
 # UPDATE A PRODUCT'S AVAILABILITY to TRUE
 ######################################################################
 @app.route("/products/<int:product_id>/enable", methods=["PUT"])
+@query_budget(2)
 def enable_product(product_id):
     """Update a Product's availability to true
     IRL, this action would add the product back to the catalog so users could order it, etc.
     """
     app.logger.info("Request to enable product with id: %s", product_id)
-    check_content_type("application/json")
-    product = Product.find(product_id)
+    product = Product.set_available(product_id, True)
     if not product:
         raise NotFound(
            "Product with id '{}' was not found.".format(product_id))
-    product.deserialize(request.get_json())
-    product.available = True
-    product.update()
-    app.logger.info("Product with ID [%s] enabled.", product.id)
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
\ No newline at end of file
+    app.logger.info("Product with ID [%s] enabled.", product_id)
+    return make_response(jsonify(product), status.HTTP_200_OK)
+
+
+######################################################################
+# UPDATE THE AVAILABILITY OF MANY PRODUCTS
+######################################################################
+@app.route("/products:disable", methods=["PUT"])
+def disable_products_batch():
+    """Update the availability of many Products to false"""
+    return set_available_batch(False)
+
+
+@app.route("/products:enable", methods=["PUT"])
+def enable_products_batch():
+    """Update the availability of many Products to true"""
+    return set_available_batch(True)
+
+
+def set_available_batch(available):
+    """Sets the availability of the Products picked by ids and filters
+
+    The ids come from an optional {"ids": [...]} body and the filters from
+    the query string, like DELETE /products; with neither, ?all=true is
+    needed to change every Product
+    """
+    app.logger.info("Request to set availability to %s with filters: %s", available, request.args.to_dict())
+    ids = None
+    if request.get_data():
+        check_content_type("application/json")
+        body = request.get_json()
+        if not isinstance(body, dict) or not isinstance(body.get("ids"), list):
+            raise DataValidationError("Invalid body: expected {\"ids\": [...]}")
+        ids = body["ids"]
+        if len(ids) > app.config["MAX_BATCH_SIZE"]:
+            raise DataValidationError(
+                "Invalid batch: at most {} ids can be sent at once".format(app.config["MAX_BATCH_SIZE"])
+            )
+    criteria = Product.filter_clauses(**batch_filter_args(targeted=ids is not None))
+    count = Product.bulk_set_available(available, ids, criteria)
+    app.logger.info("Changed the availability of %d products.", count)
+    return make_response(jsonify(updated=count), status.HTTP_200_OK)
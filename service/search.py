@@ -0,0 +1,160 @@
+"""
+Product Search
+
+Prefix and token search over Product names. PostgreSQL answers searches
+from a GIN index on to_tsvector(name); every other database uses the
+in-process inverted index in this module instead.
+
+The inverted index is built from the database on the first search and
+then kept current through the Product change listeners, so it only sees
+the writes made by this process. It is meant for SQLite in development
+and tests; run PostgreSQL when several workers write to the catalog.
+"""
+import re
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger("flask.app")
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> list:
+    """Returns the lower case words of a text, in order"""
+    return TOKEN_PATTERN.findall((text or "").lower())
+
+
+def score(name: str, terms: list, query: str, words=None) -> int:
+    """Ranks a name that matched every search term
+
+    An exact word scores 2 and a word that only starts with a term scores 1,
+    with a bonus when the whole name starts with the query, so "red" ranks
+    "Red Shirt" above "Redwood Desk".
+    """
+    if words is None:
+        words = set(tokenize(name))
+    total = 0
+    for term in terms:
+        total += 2 if term in words else 1
+    if name.lower().startswith(query.lower().strip()):
+        total += 1
+    return total
+
+
+class SearchIndex:
+    """Inverted index from the words of Product names to Product ids"""
+
+    def __init__(self):
+        self.names = {}
+        self.tokens = {}
+        self.postings = {}
+        self.words = []  # every indexed word, sorted for prefix lookups
+        self.loaded = False
+        self._lock = threading.RLock()
+
+    def load(self, rows):
+        """Replaces the index with (id, name) rows"""
+        with self._lock:
+            self._reset()
+            for product_id, name in rows:
+                self._add(product_id, name)
+            self.loaded = True
+            logger.info("Search index loaded with %d products", len(self.names))
+
+    def clear(self):
+        """Empties the index so it is loaded again on the next search"""
+        with self._lock:
+            self._reset()
+
+    def add(self, product_id: int, name: str):
+        """Indexes the name of a Product, replacing its old name"""
+        with self._lock:
+            if self.loaded:
+                self._remove(product_id)
+                self._add(product_id, name)
+
+    def remove(self, product_id: int):
+        """Removes a Product from the index"""
+        with self._lock:
+            if self.loaded:
+                self._remove(product_id)
+
+    def on_product_change(self, action: str, data: dict, before: dict = None):
+        """Product change listener that keeps the index current"""
+        if action == "reset":
+            self.clear()
+        elif action == "delete":
+            self.remove(data["id"])
+        elif before is None or before["name"] != data["name"]:
+            self.add(data["id"], data["name"])
+
+    def search(self, query: str) -> list:
+        """Returns the (score, id) of every Product matching a query
+
+        Every word of the query must be a prefix of a word in the name.
+        Results are ordered by descending score, then by id.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            matches = None
+            for term in terms:
+                ids = self._prefix_ids(term)
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+            results = [
+                (score(self.names[product_id], terms, query, self.tokens[product_id]), product_id)
+                for product_id in matches
+            ]
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results
+
+    ##################################################################
+    # Unlocked helpers
+    ##################################################################
+    def _reset(self):
+        self.names = {}
+        self.tokens = {}
+        self.postings = {}
+        self.words = []
+        self.loaded = False
+
+    def _add(self, product_id, name):
+        words = frozenset(tokenize(name))
+        self.names[product_id] = name
+        self.tokens[product_id] = words
+        for word in words:
+            ids = self.postings.get(word)
+            if ids is None:
+                ids = self.postings[word] = set()
+                bisect.insort(self.words, word)
+            ids.add(product_id)
+
+    def _remove(self, product_id):
+        self.names.pop(product_id, None)
+        words = self.tokens.pop(product_id, None)
+        if words is None:
+            return
+        for word in words:
+            ids = self.postings.get(word)
+            if ids is None:
+                continue
+            ids.discard(product_id)
+            if not ids:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def _prefix_ids(self, prefix) -> set:
+        ids = set()
+        position = bisect.bisect_left(self.words, prefix)
+        while position < len(self.words) and self.words[position].startswith(prefix):
+            ids |= self.postings[self.words[position]]
+            position += 1
+        return ids
+
+
+# The fallback index of this process, loaded by Product.search()
+search_index = SearchIndex()
@@ -44,7 +44,7 @@ $(function () {
         let name = $("#product_name").val();
         let category = $("#product_category").val();
         let price = $("#product_price").val();
-        let available = $("#product_available").val() == "true";
+        let available = $("#product_available").val() != "false";
 
         let data = {
             "name": name,
@@ -76,7 +76,7 @@ $(function () {
         let name = $("#product_name").val();
         let category = $("#product_category").val();
         let price = $("#product_price").val();
-        let available = $("#product_available").val() == "true";
+        let available = $("#product_available").val() != "false";
 
         
         let data = {
@@ -156,7 +156,8 @@ $(function () {
         let name = $("#product_name").val();
         let category = $("#product_category").val();
         let price = $("#product_price").val();
-        let available = $("#product_available").val() == "true";   
+        // empty for "Any", so the list is not filtered on availability
+        let available = $("#product_available").val();
         
         var previousQuery = false;
 
@@ -166,7 +167,8 @@ $(function () {
         };
 
         if (name) {
-            queryString += '?name=' + name;
+            // ranked prefix search on the server instead of an exact match
+            queryString += '?q=' + encodeURIComponent(name);
             previousQuery = true;
         };
 
@@ -272,4 +274,37 @@ $(function () {
         });
     });
 
-});
\ No newline at end of file
+    // *******************************************************
+    // Keep the product in the form current without polling
+    // *******************************************************
+    // Only while "Live updates" is ticked: every open stream holds a
+    // server thread, so pages do not subscribe by default
+    let events = null;
+
+    $("#live_updates").change(function () {
+        if (events) {
+            events.close();
+            events = null;
+        }
+        if (!this.checked || !window.EventSource) {
+            return;
+        }
+        events = new EventSource("/products/events?types=update,enable,disable,delete,reset");
+        ["update", "enable", "disable"].forEach(function (type) {
+            events.addEventListener(type, function (event) {
+                let product = JSON.parse(event.data);
+                if (String(product.id) == $("#product_id").val()) {
+                    update_product_form_data(product);
+                    flash_message(`Product ${product.id} was changed (${type})`);
+                }
+            });
+        });
+        events.addEventListener("delete", function (event) {
+            let product = JSON.parse(event.data);
+            if (String(product.id) == $("#product_id").val()) {
+                flash_message(`Product ${product.id} was deleted`);
+            }
+        });
+    });
+
+});
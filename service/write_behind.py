@@ -0,0 +1,167 @@
+"""
+Write-Behind Queue
+
+Optional write coalescing for high volume updates such as price feeds.
+When WRITE_BEHIND_ENABLED is set, PUT /products/{id} validates the body,
+queues it and answers 202 Accepted. Queued updates are deduplicated by id,
+so only the last write to each Product survives, and are flushed with
+Product.bulk_update() in one transaction once WRITE_BEHIND_MAX_ITEMS
+Products are waiting or the oldest has waited WRITE_BEHIND_MAX_DELAY
+seconds.
+
+The queue lives in the memory of each worker: reads see an update only
+after it is flushed, and updates still queued when a worker is killed
+are lost. Workers flush what they hold when they exit normally.
+"""
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger("flask.app")
+
+# Number of failed updates remembered for the status endpoint
+MAX_ERRORS = 100
+
+
+class WriteBehindQueue:
+    """Coalesces updates by id and writes them in batches"""
+
+    def __init__(self, flush_func=None, max_items: int = 500, max_delay: float = 1.0, clock=time.monotonic):
+        self.flush_func = flush_func
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.clock = clock
+        self.app = None
+        self.pending = OrderedDict()
+        self.oldest = None
+        self.seq = 0
+        self.flushed_seq = 0
+        self.accepted = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.batches = 0
+        self.last_flush = None
+        self.errors = deque(maxlen=MAX_ERRORS)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def configure(self, app, flush_func, max_items: int, max_delay: float):
+        """Sets the function that writes a batch and the flush triggers"""
+        self.app = app
+        self.flush_func = flush_func
+        self.max_items = max_items
+        self.max_delay = max_delay
+
+    def submit(self, product_id: int, data: dict) -> int:
+        """Queues an update and returns its sequence number
+
+        An update that is still queued for the same Product is replaced
+        """
+        with self._lock:
+            self.seq += 1
+            self.accepted += 1
+            if product_id in self.pending:
+                self.coalesced += 1
+            elif not self.pending:
+                self.oldest = self.clock()
+            self.pending[product_id] = (self.seq, dict(data, id=product_id))
+            full = len(self.pending) >= self.max_items
+            self._start()
+            self._wakeup.notify()
+            seq = self.seq
+        if full and self._thread is None:
+            self.flush()
+        return seq
+
+    def flush(self) -> int:
+        """Writes every queued update in one transaction
+
+        Returns the number of Products written
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return 0
+                batch = list(self.pending.values())
+                self.pending = OrderedDict()
+                self.oldest = None
+            items = [data for _, data in batch]
+            try:
+                if self.app is not None:
+                    with self.app.app_context():
+                        saved, errors = self.flush_func(items)
+                else:
+                    saved, errors = self.flush_func(items)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("Write-behind flush of %d updates failed", len(items))
+                saved = []
+                errors = [{"index": index, "error": str(error)} for index in range(len(items))]
+            with self._lock:
+                for error in errors:
+                    seq, data = batch[error["index"]]
+                    self.errors.append({"seq": seq, "id": data["id"], "error": error["error"]})
+                self.flushed += len(saved)
+                self.batches += 1
+                self.flushed_seq = max(seq for seq, _ in batch)
+                self.last_flush = time.time()
+            logger.info("Write-behind flushed %d updates, %d errors", len(saved), len(errors))
+            return len(saved)
+
+    def status(self) -> dict:
+        """Returns the queue counters
+
+        Every update with a seq up to flushed_seq has been written, unless
+        it is listed in errors
+        """
+        with self._lock:
+            return {
+                "pending": len(self.pending),
+                "seq": self.seq,
+                "flushed_seq": self.flushed_seq,
+                "accepted": self.accepted,
+                "coalesced": self.coalesced,
+                "flushed": self.flushed,
+                "batches": self.batches,
+                "last_flush": self.last_flush,
+                "errors": list(self.errors),
+            }
+
+    def _start(self):
+        """Starts the flushing thread of this process (called locked)"""
+        if self._thread is None and self.max_delay > 0:
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._due():
+                    timeout = None
+                    if self.oldest is not None:
+                        timeout = max(self.oldest + self.max_delay - self.clock(), 0)
+                    self._wakeup.wait(timeout)
+            self.flush()
+
+    def _due(self) -> bool:
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.max_items or self.clock() - self.oldest >= self.max_delay
+
+
+# The queue of this process, configured in init_write_behind()
+write_behind = WriteBehindQueue()
+
+
+def init_write_behind(app, flush_func):
+    """Configures the write-behind queue from the Flask app config"""
+    write_behind.configure(
+        app, flush_func, app.config["WRITE_BEHIND_MAX_ITEMS"], app.config["WRITE_BEHIND_MAX_DELAY"]
+    )
+    if app.config.get("WRITE_BEHIND_ENABLED"):
+        # gunicorn workers also flush in the worker_exit hook
+        atexit.unregister(write_behind.flush)
+        atexit.register(write_behind.flush)
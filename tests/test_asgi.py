@@ -0,0 +1,174 @@
+"""
+Test cases for the ASGI variant of the Product service
+
+"""
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+from service import status
+from service.cache import product_cache
+from service.asgi import ProductService, async_database_uri
+from .factories import ProductFactory
+
+try:
+    import aiosqlite  # noqa: F401 pylint: disable=unused-import
+    HAS_AIOSQLITE = True
+except ImportError:
+    HAS_AIOSQLITE = False
+
+
+def call(service, method, path, body=None, query_string="", content_type=b"application/json"):
+    """Sends one request to the ASGI app and returns (status, json, headers)"""
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string.encode(),
+        "headers": [(b"content-type", content_type)],
+    }
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b""}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.get_event_loop().run_until_complete(service(scope, receive, send))
+    headers = {key.decode(): value.decode() for key, value in sent[0]["headers"]}
+    content = sent[1]["body"]
+    return sent[0]["status"], json.loads(content) if content else None, headers
+
+
+class TestAsyncDatabaseUri(unittest.TestCase):
+    """ Test Cases for the async driver selection """
+
+    def test_async_database_uri(self):
+        """Pick the async driver of each database"""
+        self.assertEqual(
+            async_database_uri("postgresql://u:p@localhost:5432/db"), "postgresql+asyncpg://u:p@localhost:5432/db"
+        )
+        self.assertEqual(async_database_uri("postgres://localhost/db"), "postgresql+asyncpg://localhost/db")
+        self.assertEqual(async_database_uri("sqlite:///tmp/x.db"), "sqlite+aiosqlite:///tmp/x.db")
+
+
+######################################################################
+#  A S G I   T E S T   C A S E S
+######################################################################
+@unittest.skipUnless(HAS_AIOSQLITE, "aiosqlite is not installed")
+class TestAsyncProductService(unittest.TestCase):
+    """ ASGI Server Tests """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        uri = "sqlite:///" + os.path.join(self.tmpdir.name, "test.db")
+        self.service = ProductService(uri)
+        product_cache.clear()
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.loop.run_until_complete(self.service.shutdown())
+        self.loop.close()
+        self.tmpdir.cleanup()
+        product_cache.clear()
+
+    def _create(self):
+        data = ProductFactory().serialize()
+        del data["id"]
+        code, product, headers = call(self.service, "POST", "/products", data)
+        self.assertEqual(code, status.HTTP_201_CREATED)
+        self.assertEqual(headers["location"], "/products/{}".format(product["id"]))
+        return product
+
+    def test_create_and_get(self):
+        """Create a Product and read it back"""
+        product = self._create()
+        code, data, _ = call(self.service, "GET", "/products/{}".format(product["id"]))
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(data, product)
+        code, _, _ = call(self.service, "GET", "/products/0")
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_with_filters_and_pages(self):
+        """List Products by page"""
+        products = [self._create() for _ in range(5)]
+        code, data, headers = call(self.service, "GET", "/products", query_string="limit=2")
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual([p["id"] for p in data], [products[0]["id"], products[1]["id"]])
+        query_string = headers["link"].split("?", 1)[1].split(">")[0]
+        code, data, _ = call(self.service, "GET", "/products", query_string=query_string)
+        self.assertEqual([p["id"] for p in data], [products[2]["id"], products[3]["id"]])
+        category = products[0]["category"]
+        code, data, _ = call(self.service, "GET", "/products", query_string="category=" + category)
+        self.assertEqual(len(data), len([p for p in products if p["category"] == category]))
+
+    def test_list_pages_with_escaped_filters(self):
+        """Follow the next page of a filter that needs escaping"""
+        for _ in range(3):
+            data = dict(ProductFactory().serialize(), category="Home & Garden")
+            del data["id"]
+            call(self.service, "POST", "/products", data)
+        query_string = "category=Home%20%26%20Garden&limit=2"
+        code, data, headers = call(self.service, "GET", "/products", query_string=query_string)
+        self.assertEqual(len(data), 2)
+        query_string = headers["link"].split("?", 1)[1].split(">")[0]
+        self.assertNotIn(" ", query_string)
+        code, data, _ = call(self.service, "GET", "/products", query_string=query_string)
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(len(data), 1)
+
+    def test_update_enable_disable_delete(self):
+        """Update, disable, enable and delete a Product"""
+        product = self._create()
+        url = "/products/{}".format(product["id"])
+        code, data, _ = call(self.service, "PUT", url, dict(product, name="renamed", price=20))
+        self.assertEqual(code, status.HTTP_200_OK)
+        self.assertEqual(data["name"], "renamed")
+        # the values as stored, like the cached copy
+        self.assertIsInstance(data["price"], float)
+        self.assertEqual(product_cache.get(product["id"]), data)
+        code, data, _ = call(self.service, "PUT", url + "/disable")
+        self.assertEqual(data["available"], False)
+        code, data, _ = call(self.service, "PUT", url + "/enable")
+        self.assertEqual(data["available"], True)
+        code, _, _ = call(self.service, "DELETE", url)
+        self.assertEqual(code, status.HTTP_204_NO_CONTENT)
+        code, _, _ = call(self.service, "GET", url)
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+
+    def test_bad_requests(self):
+        """Reject invalid data and unknown paths"""
+        code, data, _ = call(self.service, "POST", "/products", {"name": "Pants"})
+        self.assertEqual(code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(data["error"], "Bad Request")
+        code, _, _ = call(self.service, "PUT", "/products/0", {})
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+        code, _, _ = call(self.service, "GET", "/products", query_string="limit=0")
+        self.assertEqual(code, status.HTTP_400_BAD_REQUEST)
+        code, _, _ = call(self.service, "POST", "/products", {}, content_type=b"text/plain")
+        self.assertEqual(code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        code, _, _ = call(self.service, "PATCH", "/products")
+        self.assertEqual(code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        code, _, _ = call(self.service, "GET", "/nothing")
+        self.assertEqual(code, status.HTTP_404_NOT_FOUND)
+
+    def test_lifespan(self):
+        """Start and stop the engine with the server"""
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        self.loop.run_until_complete(self.service({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertIsNone(self.service.engine)
@@ -0,0 +1,76 @@
+"""
+Test cases for the Product Cache
+
+"""
+from unittest import TestCase
+from service.cache import LRUCache, NullCache, ProductCache
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(TestCase):
+    """ Test Cases for the LRU Cache """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.clock = FakeClock()
+        self.cache = LRUCache(max_entries=2, ttl=10, clock=self.clock)
+
+    def test_get_and_set(self):
+        """Cache a value and count hits and misses"""
+        self.assertIsNone(self.cache.get(1))
+        self.cache.set(1, {"id": 1})
+        self.assertEqual(self.cache.get(1), {"id": 1})
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_expire(self):
+        """Expire entries after their time to live"""
+        self.cache.set(1, "a")
+        self.clock.now = 9
+        self.assertEqual(self.cache.get(1), "a")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(1))
+
+    def test_evict_least_recently_used(self):
+        """Evict the least recently used entry when full"""
+        self.cache.set(1, "a")
+        self.cache.set(2, "b")
+        self.cache.get(1)
+        self.cache.set(3, "c")
+        self.assertIsNone(self.cache.get(2))
+        self.assertEqual(self.cache.get(1), "a")
+        self.assertEqual(self.cache.get(3), "c")
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_delete_and_clear(self):
+        """Invalidate one or all entries"""
+        self.cache.set(1, "a")
+        self.cache.set(2, "b")
+        self.cache.delete(1)
+        self.assertIsNone(self.cache.get(1))
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(2))
+
+    def test_swap_backend(self):
+        """Swap the backend of the product cache"""
+        cache = ProductCache(NullCache())
+        cache.set(1, "a")
+        self.assertIsNone(cache.get(1))
+        cache.set_backend(self.cache)
+        cache.set(1, "a")
+        self.assertEqual(cache.get(1), "a")
+        self.assertEqual(cache.stats()["backend"], "LRUCache")
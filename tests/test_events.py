@@ -0,0 +1,67 @@
+"""
+Test cases for the product event broker
+
+"""
+import unittest
+from service.events import EventBroker, event_type, format_event
+
+
+def product(available=True, price=1.0):
+    """Returns the data of a Product"""
+    return {"id": 1, "name": "Pen", "category": "Office", "price": price, "available": available}
+
+
+class TestEventBroker(unittest.TestCase):
+    """ Test Cases for EventBroker """
+
+    def setUp(self):
+        self.broker = EventBroker(max_events=2, history=3, max_subscribers=2)
+
+    def test_event_type(self):
+        """Tell availability flips apart from other updates"""
+        self.assertEqual(event_type("update", product(False), product(True)), "disable")
+        self.assertEqual(event_type("update", product(True), product(False)), "enable")
+        self.assertEqual(event_type("update", product(False, 2.0), product(True)), "update")
+        self.assertEqual(event_type("update", product(), None), "update")
+        self.assertEqual(event_type("delete", product()), "delete")
+
+    def test_publish(self):
+        """Deliver events to the subscribers that want them"""
+        everything = self.broker.subscribe()
+        flips = self.broker.subscribe(["disable"])
+        self.broker.on_product_change("create", product())
+        self.broker.on_product_change("update", product(False), product(True))
+        self.assertEqual(everything.get(0)["type"], "create")
+        self.assertEqual(everything.get(0)["type"], "disable")
+        event = flips.get(0)
+        self.assertEqual((event["id"], event["type"]), (2, "disable"))
+        self.assertIsNone(flips.get(0))
+        self.assertEqual(format_event(event).split(b"\n")[:2], [b"id: 2", b"event: disable"])
+
+    def test_backpressure(self):
+        """Replace the buffer of a slow subscriber with a reset"""
+        subscription = self.broker.subscribe()
+        for _ in range(3):
+            self.broker.publish("create", product())
+        self.assertEqual(subscription.get(0), {"id": 3, "type": "reset", "data": None})
+        self.assertIsNone(subscription.get(0))
+        self.assertEqual(self.broker.stats()["overflows"], 1)
+
+    def test_replay(self):
+        """Replay the missed events after a reconnect"""
+        for _ in range(4):
+            self.broker.publish("create", product())
+        subscription = self.broker.subscribe(last_event_id=3)
+        self.assertEqual(subscription.get(0)["id"], 4)
+        # the events after 0 are no longer kept
+        subscription = self.broker.subscribe(last_event_id=0)
+        self.assertEqual(subscription.get(0)["type"], "reset")
+
+    def test_max_subscribers(self):
+        """Refuse subscribers past the limit"""
+        first = self.broker.subscribe()
+        self.broker.subscribe()
+        self.assertIsNone(self.broker.subscribe())
+        self.broker.unsubscribe(first)
+        self.assertTrue(first.closed)
+        self.assertIsNotNone(self.broker.subscribe())
@@ -0,0 +1,73 @@
+"""
+Test cases for the facet summary
+
+"""
+import unittest
+from service.facets import FacetSummary
+
+
+def product(product_id, category, price, available=True):
+    """Returns the data of a Product"""
+    return {"id": product_id, "name": "x", "category": category, "price": price, "available": available}
+
+
+class TestFacetSummary(unittest.TestCase):
+    """ Test Cases for FacetSummary """
+
+    def setUp(self):
+        self.now = 0.0
+        self.summary = FacetSummary([10, 100], ttl=60, clock=lambda: self.now)
+        self.summary.load([
+            ("Office", True, 0, 2, 1.0, 9.0, 10.0),
+            ("Office", False, 2, 1, 500.0, 500.0, 500.0),
+            ("Clothes", True, 1, 1, 50.0, 50.0, 50.0),
+        ])
+
+    def test_summary(self):
+        """Describe each category and the totals"""
+        data = self.summary.summary()
+        self.assertEqual(data["count"], 4)
+        self.assertEqual(data["available"], 3)
+        self.assertEqual(data["min_price"], 1.0)
+        self.assertEqual(data["max_price"], 500.0)
+        self.assertEqual([bucket["count"] for bucket in data["price_histogram"]], [2, 1, 1])
+        self.assertEqual(data["price_histogram"][-1]["max_price"], None)
+        office = data["categories"][1]
+        self.assertEqual(office["category"], "Office")
+        self.assertEqual(office["unavailable"], 1)
+        self.assertEqual(office["avg_price"], 170.0)
+
+    def test_bucket(self):
+        """Find the histogram bucket of a price"""
+        self.assertEqual(self.summary.bucket(10), 0)
+        self.assertEqual(self.summary.bucket(10.5), 1)
+        self.assertEqual(self.summary.bucket(1000), 2)
+
+    def test_changes(self):
+        """Update the counts in place"""
+        self.summary.on_product_change("create", product(5, "Toys", 20.0))
+        self.summary.on_product_change("update", product(2, "Office", 5.0, False), product(2, "Office", 5.0))
+        self.summary.on_product_change("delete", product(2, "Office", 5.0, False))
+        data = self.summary.summary()
+        self.assertTrue(self.summary.loaded)
+        self.assertEqual(data["count"], 4)
+        self.assertEqual(data["available"], 3)
+        self.assertEqual(data["categories"][2]["category"], "Toys")
+
+    def test_unknown_changes(self):
+        """Reload when a change cannot be applied in place"""
+        self.summary.on_product_change("update", product(1, "Office", 5.0), None)
+        self.assertFalse(self.summary.loaded)
+        self.setUp()
+        # the lowest price of a category went away
+        self.summary.on_product_change("delete", product(1, "Office", 1.0))
+        self.assertFalse(self.summary.loaded)
+        self.setUp()
+        self.summary.on_product_change("reset", None)
+        self.assertFalse(self.summary.loaded)
+
+    def test_ttl(self):
+        """Expire the summary after its time to live"""
+        self.assertTrue(self.summary.is_current())
+        self.now = 61
+        self.assertFalse(self.summary.is_current())
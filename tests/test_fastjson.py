@@ -0,0 +1,26 @@
+"""
+Test cases for the fast JSON encoder
+
+"""
+import json
+from unittest import TestCase
+from service import fastjson
+
+
+######################################################################
+#  F A S T J S O N   T E S T   C A S E S
+######################################################################
+class TestFastJson(TestCase):
+    """ Test Cases for fastjson """
+
+    def test_dumps(self):
+        """Encode data as compact JSON bytes"""
+        data = [{"id": 1, "name": "Pen", "price": 1.99, "available": True}]
+        body = fastjson.dumps(data)
+        self.assertIsInstance(body, bytes)
+        self.assertNotIn(b" ", body)
+        self.assertEqual(json.loads(body), data)
+
+    def test_encoder_name(self):
+        """Report the encoder in use"""
+        self.assertIn(fastjson.encoder_name(), ["orjson", "json"])
@@ -0,0 +1,38 @@
+"""
+Test cases for the request instrumentation
+
+"""
+from unittest import TestCase
+from service.instrumentation import Registry, RequestMetrics
+
+
+######################################################################
+#  I N S T R U M E N T A T I O N   T E S T   C A S E S
+######################################################################
+class TestRegistry(TestCase):
+    """ Test Cases for the metrics Registry """
+
+    def test_render_histogram(self):
+        """Render a latency histogram in the Prometheus format"""
+        registry = Registry()
+        metrics = RequestMetrics()
+        metrics.add_statement("SELECT 1", 0.002)
+        metrics.add_statement("SELECT 2", 0.003)
+        registry.observe("GET", "/products", 0.02, 200, metrics, 100)
+        registry.observe("GET", "/products", 3.0, 500, RequestMetrics(), 10)
+        body = registry.render({"product_cache_hits": 4})
+        labels = 'method="GET",route="/products"'
+        self.assertIn('http_request_duration_seconds_bucket{%s,le="0.01"} 0' % labels, body)
+        self.assertIn('http_request_duration_seconds_bucket{%s,le="0.025"} 1' % labels, body)
+        self.assertIn('http_request_duration_seconds_bucket{%s,le="+Inf"} 2' % labels, body)
+        self.assertIn('http_requests_total{%s,status="500"} 1' % labels, body)
+        self.assertIn("db_statements_total{%s} 2" % labels, body)
+        self.assertIn("http_response_bytes_total{%s} 110" % labels, body)
+        self.assertIn("product_cache_hits 4", body)
+
+    def test_reset(self):
+        """Forget every measurement"""
+        registry = Registry()
+        registry.observe("GET", "/", 0.1, 200, RequestMetrics(), 0)
+        registry.reset()
+        self.assertNotIn("route=", registry.render())
@@ -6,8 +6,11 @@ import logging
 import unittest
 import os
 from werkzeug.exceptions import NotFound
-from service.models import Product, DataValidationError, db
+from service.models import Product, DataValidationError, DataConflictError, DataStaleError, db
 from service import app
+from service.cache import product_cache
+from service.search import search_index
+from service.facets import facet_summary
 from .factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -37,6 +40,9 @@ class TestProductModel(unittest.TestCase):
     def setUp(self):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
+        product_cache.clear()
+        search_index.clear()
+        facet_summary.clear()
         db.create_all()  # make our sqlalchemy tables
 
     def tearDown(self):
@@ -106,6 +112,21 @@ class TestProductModel(unittest.TestCase):
         self.assertEqual(products[0].id, 1)
         self.assertEqual(products[0].category, "Office")
 
+    def test_update_if_unchanged(self):
+        """Update a Product only if its change_seq is the one read"""
+        product = ProductFactory()
+        product.create()
+        seq = product.change_seq
+        product.category = "Office"
+        product.update(seq)
+        self.assertEqual(Product.find(product.id).category, "Office")
+        # another writer commits between the read and this update
+        with db.engine.begin() as conn:
+            conn.execute(Product.__table__.update().values(category="Garden"))
+        product.category = "Kitchen"
+        self.assertRaises(DataStaleError, product.update, product.change_seq)
+        self.assertEqual(Product.find(product.id).category, "Garden")
+
     def test_delete_a_product(self):
         """Delete a Product"""
         product = ProductFactory()
@@ -242,4 +263,345 @@ class TestProductModel(unittest.TestCase):
 
     def test_find_or_404_not_found(self):
         """Find or return 404 NOT found"""
-        self.assertRaises(NotFound, Product.find_or_404, 0)
\ No newline at end of file
+        self.assertRaises(NotFound, Product.find_or_404, 0)
+
+    def test_paginate(self):
+        """Page through Products with a cursor"""
+        for product in ProductFactory.create_batch(5):
+            product.create()
+        page, cursor = Product.paginate(2)
+        self.assertEqual([product.id for product in page], [1, 2])
+        self.assertIsNotNone(cursor)
+        page, cursor = Product.paginate(2, cursor)
+        self.assertEqual([product.id for product in page], [3, 4])
+        page, cursor = Product.paginate(2, cursor)
+        self.assertEqual([product.id for product in page], [5])
+        self.assertIsNone(cursor)
+
+    def test_paginate_by_sort_key(self):
+        """Page through a filtered query ordered by price"""
+        Product(name="Pen", category="Stationary", available=True, price=10.0).create()
+        Product(name="Pants", category="Clothes", available=False, price=49.99).create()
+        Product(name="Shirt", category="Clothes", available=True, price=5.0).create()
+        Product(name="Hat", category="Clothes", available=True, price=49.99).create()
+        query = Product.find_by_category("Clothes")
+        page, cursor = Product.paginate(2, sort="-price", query=query)
+        self.assertEqual([product.name for product in page], ["Hat", "Pants"])
+        page, cursor = Product.paginate(2, cursor, sort="-price", query=query)
+        self.assertEqual([product.name for product in page], ["Shirt"])
+        self.assertIsNone(cursor)
+
+    def test_paginate_bad_cursor(self):
+        """Reject cursors that are malformed or issued for another sort key"""
+        for product in ProductFactory.create_batch(3):
+            product.create()
+        self.assertRaises(DataValidationError, Product.paginate, 2, "not-a-cursor")
+        _, cursor = Product.paginate(2)
+        self.assertRaises(DataValidationError, Product.paginate, 2, cursor, "price")
+        self.assertRaises(DataValidationError, Product.paginate, 2, sort="bogus")
+        for value in [[1, 2], "10", True, None]:
+            forged = Product.encode_cursor("price", value, 1)
+            self.assertRaises(DataValidationError, Product.paginate, 2, forged, "price")
+        forged = Product.encode_cursor("name", 10, 1)
+        self.assertRaises(DataValidationError, Product.paginate, 2, forged, "name")
+        forged = Product.encode_cursor("-price", 10.0, "1")
+        self.assertRaises(DataValidationError, Product.paginate, 2, forged, "-price")
+
+    def test_sort_order(self):
+        """Order Products by a whitelisted key with the id as tie breaker"""
+        Product(name="Pen", category="Office", available=True, price=10.0).create()
+        Product(name="Desk", category="Office", available=True, price=200.0).create()
+        Product(name="Clip", category="Office", available=True, price=10.0).create()
+        names = [product.name for product in Product.query.order_by(*Product.sort_order("-price"))]
+        self.assertEqual(names, ["Desk", "Clip", "Pen"])
+        names = [product.name for product in Product.iterate(sort="name")]
+        self.assertEqual(names, ["Clip", "Desk", "Pen"])
+        for sort in ["bogus", "--price", "-", ""]:
+            self.assertRaises(DataValidationError, Product.sort_order, sort)
+
+    @unittest.skipUnless(DATABASE_URI.startswith("sqlite"), "query plans are checked on SQLite")
+    def test_sort_uses_index(self):
+        """Serve the sorted pages of a category from an index"""
+        query = Product.find_by_category("Office").order_by(*Product.sort_order("-price")).limit(10)
+        sql = str(query.statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        with db.engine.connect() as conn:
+            plan = " ".join(row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql))
+        self.assertIn("ix_product_category_price_id", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_iterate(self):
+        """Iterate over a query in batches"""
+        for product in ProductFactory.create_batch(5):
+            product.create()
+        products = list(Product.iterate(batch_size=2))
+        self.assertEqual([product.id for product in products], [1, 2, 3, 4, 5])
+        query = Product.find_by_name(products[0].name)
+        for product in Product.iterate(query):
+            self.assertEqual(product.name, products[0].name)
+
+    def test_find_by_filters(self):
+        """Find Products matching several filters at once"""
+        Product(name="Pen", category="Stationary", available=True, price=10.0).create()
+        Product(name="Pants", category="Clothes", available=False, price=49.99).create()
+        Product(name="Shirt", category="Clothes", available=True, price=25.0).create()
+        Product(name="Hat", category="Clothes", available=True, price=99.0).create()
+        products = Product.find_by_filters(category="Clothes", available=True)
+        self.assertEqual(sorted(p.name for p in products), ["Hat", "Shirt"])
+        products = Product.find_by_filters(
+            category="Clothes", available=True, minimum=20, maximum=50
+        )
+        self.assertEqual([p.name for p in products], ["Shirt"])
+        products = Product.find_by_filters(name="Pen", category="Clothes")
+        self.assertEqual(products.count(), 0)
+        self.assertEqual(Product.find_by_filters().count(), 4)
+
+    def test_bulk_create(self):
+        """Create many Products in one transaction"""
+        items = [ProductFactory().serialize() for _ in range(3)]
+        items.insert(1, {"name": "Pants"})
+        products, errors = Product.bulk_create(items)
+        self.assertEqual(len(products), 3)
+        self.assertTrue(all(product["id"] for product in products))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["index"], 1)
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_bulk_update(self):
+        """Update many Products in one transaction"""
+        items, _ = Product.bulk_create([ProductFactory().serialize() for _ in range(3)])
+        for item in items:
+            item["category"] = "Office"
+        items.append(dict(items[0], id=0))
+        items.append({"name": "no id", "category": "Office", "available": True, "price": 1})
+        updated, errors = Product.bulk_update(items)
+        self.assertEqual(len(updated), 3)
+        self.assertEqual([error["index"] for error in errors], [3, 4])
+        self.assertEqual(Product.find_by_category("Office").count(), 3)
+
+    def test_bulk_delete(self):
+        """Delete the Products matched by a query"""
+        Product(name="Pen", category="Stationary", available=True, price=10.0).create()
+        Product(name="Pants", category="Clothes", available=False, price=49.99).create()
+        Product(name="Shirt", category="Clothes", available=True, price=25.0).create()
+        count = Product.bulk_delete(Product.find_by_category("Clothes"))
+        self.assertEqual(count, 2)
+        self.assertEqual([p.name for p in Product.all()], ["Pen"])
+        self.assertEqual(Product.bulk_delete(), 1)
+        self.assertEqual(Product.all(), [])
+
+    def test_find_serialized(self):
+        """Find a serialized Product through the cache"""
+        product = ProductFactory()
+        product.create()
+        product_cache.clear()
+        misses = product_cache.stats()["misses"]
+        data = Product.find_serialized(product.id)
+        self.assertEqual(data, product.serialize())
+        self.assertEqual(Product.find_serialized(product.id), data)
+        self.assertEqual(product_cache.stats()["misses"], misses + 1)
+        # writes invalidate the cached copy
+        product.category = "Office"
+        product.update()
+        self.assertEqual(Product.find_serialized(product.id)["category"], "Office")
+        product.delete()
+        self.assertIsNone(Product.find_serialized(product.id))
+
+    def test_select_fields(self):
+        """Load only some of the columns of the Products"""
+        for product in ProductFactory.create_batch(3):
+            product.create()
+        rows = Product.select_fields(["id", "price"]).all()
+        self.assertEqual(len(rows), 3)
+        data = Product.serialize_fields(rows[0], ["id", "price"])
+        self.assertEqual(sorted(data.keys()), ["id", "price"])
+        query = Product.find_by_name("no such product")
+        self.assertEqual(Product.select_fields(["name"], query).all(), [])
+        self.assertRaises(DataValidationError, Product.select_fields, ["id", "secret"])
+
+    def test_search(self):
+        """Search Products by the words of their names"""
+        names = ["Blue Shirt", "Shirt Blue", "Bluetooth Speaker", "Red Shirt", "Blue"]
+        for name in names:
+            ProductFactory(name=name, category="Clothes").create()
+        rows, cursor = Product.search("blue", 10)
+        self.assertIsNone(cursor)
+        # exact words and names starting with the query rank first
+        self.assertEqual([row.name for row in rows], ["Blue Shirt", "Blue", "Shirt Blue", "Bluetooth Speaker"])
+        rows, _ = Product.search("sh blu", 10)
+        self.assertEqual(sorted(row.name for row in rows), ["Blue Shirt", "Shirt Blue"])
+        self.assertEqual(Product.search("green", 10), ([], None))
+        self.assertEqual(Product.search("  !", 10), ([], None))
+
+    def test_search_pages_and_filters(self):
+        """Page through search results within other filters"""
+        for index in range(5):
+            ProductFactory(name="desk {}".format(index), category="Office", available=index % 2 == 0).create()
+        seen, cursor = [], None
+        while True:
+            rows, cursor = Product.search("desk", 2, cursor)
+            seen += [row.id for row in rows]
+            if cursor is None:
+                break
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+        query = Product.select_fields(Product.FIELDS, Product.find_by_filters(available=True))
+        rows, _ = Product.search("desk", 10, query=query)
+        self.assertEqual(len(rows), 3)
+        self.assertRaises(DataValidationError, Product.search, "desk", 2, "bogus")
+
+    def test_search_follows_changes(self):
+        """Keep the search index current as Products change"""
+        product = ProductFactory(name="Lamp")
+        product.create()
+        self.assertEqual(len(Product.search("lamp", 10)[0]), 1)
+        product.name = "Chair"
+        product.update()
+        self.assertEqual(Product.search("lamp", 10)[0], [])
+        self.assertEqual(len(Product.search("chair", 10)[0]), 1)
+        product.delete()
+        self.assertEqual(Product.search("chair", 10)[0], [])
+        Product.bulk_create([{"name": "Lamp", "category": "Office", "price": 1, "available": True}])
+        self.assertEqual(len(Product.search("lamp", 10)[0]), 1)
+        Product.bulk_delete()
+        self.assertEqual(Product.search("lamp", 10)[0], [])
+
+    def test_facets(self):
+        """Keep the facets equal to a fresh GROUP BY as Products change"""
+        products = ProductFactory.create_batch(10)
+        for product in products:
+            product.create()
+        facets = Product.facets()
+        self.assertEqual(facets["count"], 10)
+        self.assertEqual(sum(category["count"] for category in facets["categories"]), 10)
+        self.assertEqual(facets["available"], len([p for p in products if p.available]))
+
+        # writes update the loaded summary in place
+        products[0].available = not products[0].available
+        products[0].update()
+        products[1].delete()
+        ProductFactory(price=75.0).create()
+        Product.bulk_update([dict(products[2].serialize(), category="Office")])
+        maintained = Product.facets()
+        facet_summary.clear()
+        self.assertEqual(maintained, Product.facets())
+
+    def test_loaded_data(self):
+        """Serialize a Product as it was before unsaved changes"""
+        product = ProductFactory(price=10.0)
+        product.create()
+        product = Product.find(product.id)
+        before = product.serialize()
+        product.price = 20.0
+        self.assertEqual(product.loaded_data(), before)
+        db.session.expire(product, ["price"])
+        product.price = 30.0
+        self.assertIsNone(product.loaded_data())
+
+    def test_set_available(self):
+        """Flip the availability of a Product without loading it"""
+        product = ProductFactory(available=True)
+        product.create()
+        Product.facets()
+        data = Product.set_available(product.id, False)
+        self.assertEqual(data, dict(product.serialize(), available=False))
+        self.assertEqual(Product.set_available(product.id, False), data)
+        self.assertEqual(Product.find_serialized(product.id)["available"], False)
+        self.assertEqual(Product.facets()["available"], 0)
+        self.assertIsNone(Product.set_available(0, True))
+
+    def test_bulk_set_available(self):
+        """Flip the availability of many Products at once"""
+        products = [ProductFactory(available=False, category=category) for category in ["Office"] * 3 + ["Clothes"]]
+        for product in products:
+            product.create()
+        ids = [product.id for product in products[:2]]
+        self.assertEqual(Product.bulk_set_available(True, ids), 2)
+        self.assertEqual(Product.bulk_set_available(True, ids), 0)
+        office = Product.filter_clauses(category="Office")
+        self.assertEqual(Product.bulk_set_available(True, criteria=office), 1)
+        self.assertEqual(Product.find_by_availability(True).count(), 3)
+        self.assertEqual(Product.bulk_set_available(False), 3)
+        self.assertRaises(DataValidationError, Product.bulk_set_available, True, ["1"])
+
+    def test_upgrade_schema(self):
+        """Add the columns and indexes missing from an old product table"""
+        db.session.remove()
+        Product.__table__.drop(db.engine)
+        old = db.Table(
+            "product",
+            db.MetaData(),
+            db.Column("id", db.Integer, primary_key=True),
+            db.Column("name", db.String(63), nullable=False),
+            db.Column("category", db.String(63), nullable=False),
+            db.Column("available", db.Boolean(), nullable=False),
+            db.Column("price", db.Float(), nullable=False),
+        )
+        old.create(db.engine)
+        with db.engine.begin() as conn:
+            conn.execute(old.insert(), {"name": "Pen", "category": "Office", "available": True, "price": 1.5})
+        Product.upgrade_schema()
+        Product.upgrade_schema()
+        self.assertEqual([product.name for product in Product.all()], ["Pen"])
+        changes, _, checkpoint = Product.changes(0)
+        self.assertEqual([change["product"]["name"] for change in changes], ["Pen"])
+        self.assertIsNotNone(Product.all()[0].updated_at)
+        item = {"name": "Ink", "category": "Office", "available": True, "price": 2.5, "sku": "INK-1"}
+        Product.upsert([item])
+        self.assertEqual([change["product"]["sku"] for change in Product.changes(checkpoint)[0]], ["INK-1"])
+        self.assertRaises(DataConflictError, Product(name="Nib", category="Office", available=True, price=1,
+                                                     sku="INK-1").create)
+        indexes = {index["name"] for index in db.inspect(db.engine).get_indexes("product")}
+        self.assertTrue({index.name for index in Product.__table__.indexes} <= indexes)
+        if db.engine.dialect.name == "postgresql":
+            search_index = db.text("SELECT to_regclass('ix_product_name_search')")
+            self.assertIsNotNone(db.session.execute(search_index).scalar())
+
+    def test_upsert(self):
+        """Create or update Products keyed on their sku"""
+        item = {"name": "Pen", "category": "Office", "price": 1.5, "available": True, "sku": "P-1"}
+        saved, errors = Product.upsert([item])
+        self.assertEqual(errors, [])
+        (data, created), = saved
+        self.assertTrue(created)
+        saved, _ = Product.upsert([dict(item, price=2.0)])
+        self.assertEqual(saved, [(dict(data, price=2.0), False)])
+        self.assertEqual(Product.find_serialized(data["id"])["price"], 2.0)
+        saved, errors = Product.upsert([dict(item, sku=None), dict(item, sku="")])
+        self.assertEqual((saved, len(errors)), ([], 2))
+
+    def test_sku(self):
+        """Keep the sku unless it is sent, and keep it unique"""
+        product = ProductFactory(sku="A-1")
+        product.create()
+        data = product.serialize()
+        del data["sku"]
+        product.deserialize(data)
+        self.assertEqual(product.sku, "A-1")
+        self.assertRaises(DataValidationError, product.deserialize, dict(data, sku=7))
+        self.assertRaises(DataConflictError, ProductFactory(sku="A-1").create)
+        self.assertEqual(Product.find(product.id).sku, "A-1")
+
+    def test_changes(self):
+        """List the changes after a checkpoint, deletes included"""
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.create()
+        ids = [product.id for product in products]
+        changes, cursor, checkpoint = Product.changes()
+        self.assertEqual([change["id"] for change in changes], ids)
+        self.assertIsNone(cursor)
+        products[0].price += 1
+        products[0].update()
+        Product.set_available(products[1].id, not products[1].available)
+        products[2].delete()
+        changes, cursor, newest = Product.changes(checkpoint, limit=2)
+        self.assertEqual([change["id"] for change in changes], ids[:2])
+        self.assertEqual(changes[0]["product"]["price"], products[0].price)
+        more, cursor, newest = Product.changes(checkpoint, limit=2, cursor=cursor)
+        self.assertEqual([(change["id"], change["deleted"]) for change in more], [(ids[2], True)])
+        self.assertIsNone(cursor)
+        self.assertEqual(Product.changes(newest), ([], None, newest))
+        Product.bulk_delete()
+        changes, _, _ = Product.changes(newest)
+        self.assertEqual({change["id"] for change in changes}, set(ids[:2]))
+        self.assertRaises(DataValidationError, Product.changes, 0, 10, "bad")
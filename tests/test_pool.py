@@ -0,0 +1,50 @@
+"""
+Test cases for the Connection Pool statistics
+
+"""
+from unittest import TestCase
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from service.pool import InstrumentedQueuePool, pool_stats
+
+
+######################################################################
+#  P O O L   T E S T   C A S E S
+######################################################################
+class TestInstrumentedQueuePool(TestCase):
+    """ Test Cases for the instrumented pool """
+
+    def setUp(self):
+        """ This runs before each test """
+        self.engine = create_engine(
+            "sqlite://",
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.05,
+        )
+
+    def tearDown(self):
+        """ This runs after each test """
+        self.engine.dispose()
+
+    def test_pool_stats(self):
+        """Report checked out connections"""
+        conn = self.engine.connect()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats["pool"], "InstrumentedQueuePool")
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["checked_out"], 1)
+        self.assertEqual(stats["waits"], 0)
+        conn.close()
+        self.assertEqual(pool_stats(self.engine)["checked_in"], 1)
+
+    def test_count_waits_and_timeouts(self):
+        """Count checkouts that waited for an exhausted pool"""
+        conn = self.engine.connect()
+        self.assertRaises(PoolTimeoutError, self.engine.connect)
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats["waits"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertGreater(stats["wait_time"], 0)
+        conn.close()
@@ -0,0 +1,57 @@
+"""
+Test cases for the N+1 and slow query detector
+
+"""
+from unittest import TestCase
+from service.query_detector import find_violations, query_budget
+
+
+######################################################################
+#  Q U E R Y   D E T E C T O R   T E S T   C A S E S
+######################################################################
+class TestQueryDetector(TestCase):
+    """ Test Cases for the query detector """
+
+    def test_within_budget(self):
+        """Accept requests that stay within their budget"""
+        statements = [("SELECT 1", (), 0.001), ("SELECT 2", (), 0.001)]
+        self.assertEqual(find_violations(statements, 2, 100, 3), [])
+
+    def test_over_budget(self):
+        """Flag requests that issue too many statements"""
+        statements = [("SELECT 1", (), 0.001), ("SELECT 2", (), 0.001)]
+        violations = find_violations(statements, 1, 100, 3)
+        self.assertEqual([kind for kind, _, _ in violations], ["budget"])
+
+    def test_slow_statement(self):
+        """Flag statements slower than the threshold"""
+        statements = [("SELECT 1", (), 0.5)]
+        violations = find_violations(statements, 10, 100, 3)
+        self.assertEqual(violations[0][0], "slow")
+        self.assertEqual(violations[0][2], ("SELECT 1", ()))
+
+    def test_repeated_statement(self):
+        """Flag the same statement run in a loop"""
+        sql = "SELECT * FROM product WHERE id = ?"
+        statements = [(sql, (i,), 0.001) for i in range(5)]
+        violations = find_violations(statements, 10, 100, 3)
+        self.assertEqual(violations[0][0], "repeat")
+        self.assertEqual(violations[0][2], (sql, (0,)))
+
+    def test_repeated_write(self):
+        """Count a run of the same INSERT as one statement, never as an N+1"""
+        sql = "INSERT INTO product (name) VALUES (?)"
+        statements = [(sql, ("Pen",), 0.001) for _ in range(5)] + [("SELECT 1", (), 0.001)]
+        self.assertEqual(find_violations(statements, 2, 100, 3), [])
+        statements.append((sql, ("Ink",), 0.001))
+        self.assertEqual(find_violations(statements, 2, 100, 3)[0][0], "budget")
+
+    def test_query_budget(self):
+        """Declare the budget of a view"""
+
+        @query_budget(4)
+        def view():
+            return None
+
+        self.assertEqual(view.query_budget, 4)
+        self.assertIsNone(view.query_budget_items)
@@ -6,12 +6,18 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from service import status  # HTTP Status Codes
-from service.models import db
+from service.models import db, Product
+from service.cache import product_cache
+from service.search import search_index
+from service.facets import facet_summary
+from service.write_behind import write_behind
 from service.routes import app, init_db
+from service.query_detector import QueryBudgetExceeded
 from .factories import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -33,6 +39,14 @@ class TestProductServer(TestCase):
         app.config["DEBUG"] = False
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        # fail on query budget and N+1 violations, but not on a slow commit
+        cls.detector_config = {
+            key: app.config[key]
+            for key in ("QUERY_DETECTOR_ENABLED", "QUERY_DETECTOR_RAISE", "QUERY_DETECTOR_SLOW_MS")
+        }
+        app.config["QUERY_DETECTOR_ENABLED"] = True
+        app.config["QUERY_DETECTOR_RAISE"] = True
+        app.config["QUERY_DETECTOR_SLOW_MS"] = float("inf")
         app.logger.setLevel(logging.CRITICAL)
         #init_db(app)
         init_db()
@@ -41,10 +55,14 @@ class TestProductServer(TestCase):
     def tearDownClass(cls):
         """ This runs once after the entire test suite """
         db.session.close()
+        app.config.update(cls.detector_config)
 
     def setUp(self):
         """ This runs before each test """
         db.drop_all()  # clean up the last tests
+        product_cache.clear()
+        search_index.clear()
+        facet_summary.clear()
         db.create_all()  # create new tables
         self.app = app.test_client()
 
@@ -118,6 +136,283 @@ class TestProductServer(TestCase):
         data = resp.get_json()
         self.assertEqual(len(data), len(price_products))
 
+    def test_query_open_price_range(self):
+        """Query Products with only one end of the price range"""
+        products = self._create_products(10)
+        bound = products[0].price
+        resp = self.app.get(BASE_URL, query_string="minimum={}".format(bound))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), len([p for p in products if p.price >= bound]))
+        resp = self.app.get(BASE_URL, query_string="maximum={}&category=Office".format(bound))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        expected = [p for p in products if p.price <= bound and p.category == "Office"]
+        self.assertEqual(len(resp.get_json()), len(expected))
+
+    def test_query_bad_price_range(self):
+        """Reject prices that are not finite numbers and empty ranges"""
+        for query_string in ["minimum=abc", "maximum=nan", "minimum=inf", "maximum=1e999", "minimum=-1",
+                             "minimum=10&maximum=5"]:
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+
+    def test_get_product_list_paginated(self):
+        """Page through the list of Products using the Link header"""
+        self._create_products(5)
+        resp = self.app.get(BASE_URL, query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        seen = [product["id"] for product in resp.get_json()]
+        while "Link" in resp.headers:
+            next_url = resp.headers["Link"].split(";")[0].strip("<>")
+            resp = self.app.get(next_url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen += [product["id"] for product in resp.get_json()]
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(set(seen)))
+
+    def test_get_product_list_sorted(self):
+        """Sort the list of Products, also page by page"""
+        products = self._create_products(6)
+        resp = self.app.get(BASE_URL, query_string="sort=-price&fields=price")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        prices = [product["price"] for product in resp.get_json()]
+        self.assertEqual(prices, sorted((product.price for product in products), reverse=True))
+        resp = self.app.get(BASE_URL, query_string="sort=name&limit=4&fields=id")
+        seen = resp.get_json()
+        self.assertEqual(list(seen[0].keys()), ["id"])
+        next_url = resp.headers["Link"].split(";")[0].strip("<>")
+        seen += self.app.get(next_url).get_json()
+        ordered = sorted(products, key=lambda product: (product.name, product.id))
+        self.assertEqual([product["id"] for product in seen], [product.id for product in ordered])
+        resp = self.app.get(BASE_URL, query_string="sort=price", headers={"Accept": "application/x-ndjson"})
+        prices = [json.loads(line)["price"] for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(prices, sorted(prices))
+
+    def test_get_product_list_bad_sort(self):
+        """Reject sort keys outside the whitelist"""
+        for query_string in ["sort=available", "sort=-secret", "sort=price&q=pen"]:
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+
+    def test_get_product_list_bad_page(self):
+        """Reject bad page sizes and cursors"""
+        forged = Product.encode_cursor("price", [1, 2], 1)
+        for query_string in [
+            "limit=0",
+            "limit=abc",
+            "limit=2&cursor=bogus",
+            "limit=2&sort=price&cursor=" + forged,
+        ]:
+            resp = self.app.get(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        self._create_products(3)
+        _, cursor = Product.paginate(2)
+        resp = self.app.get(BASE_URL, query_string={"cursor": cursor})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_products(self):
+        """Search Products by name one page at a time"""
+        for name in ["Blue Shirt", "Blue Pants", "Blueberry Jam", "Red Shirt"]:
+            product = ProductFactory(name=name)
+            resp = self.app.post(BASE_URL, json=product.serialize(), content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.get(BASE_URL, query_string="q=blu&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        names = [product["name"] for product in resp.get_json()]
+        self.assertEqual(names, ["Blue Shirt", "Blue Pants"])
+        next_url = resp.headers["Link"].split(";")[0].strip("<>")
+        resp = self.app.get(next_url)
+        self.assertEqual([product["name"] for product in resp.get_json()], ["Blueberry Jam"])
+        self.assertNotIn("Link", resp.headers)
+        resp = self.app.get(BASE_URL, query_string="q=shirt&fields=name")
+        self.assertEqual(resp.get_json(), [{"name": "Blue Shirt"}, {"name": "Red Shirt"}])
+        resp = self.app.get(BASE_URL, query_string="q=shirt&cursor=bogus")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_facets(self):
+        """Get the counts and prices of each category"""
+        products = self._create_products(6)
+        resp = self.app.get(BASE_URL + "/facets")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["count"], 6)
+        categories = {category["category"]: category for category in data["categories"]}
+        clothes = [product for product in products if product.category == products[0].category]
+        self.assertEqual(categories[products[0].category]["count"], len(clothes))
+        self.assertEqual(
+            categories[products[0].category]["max_price"], max(product.price for product in clothes)
+        )
+        self.assertEqual(sum(bucket["count"] for bucket in data["price_histogram"]), 6)
+        # disabling a Product moves it between the availability counts
+        self.app.put(
+            "{}/{}/disable".format(BASE_URL, products[0].id),
+            json=products[0].serialize(),
+            content_type=CONTENT_TYPE_JSON,
+        )
+        data = self.app.get(BASE_URL + "/facets").get_json()
+        self.assertEqual(data["available"], len([p for p in products[1:] if p.available]))
+
+    def test_stream_product_list_ndjson(self):
+        """Stream the list of Products as NDJSON"""
+        products = self._create_products(3)
+        resp = self.app.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        # still streamed after the after_request hooks, not buffered
+        self.assertNotIn("Content-Length", resp.headers)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])["name"], products[0].name)
+
+    def test_stream_product_list_json(self):
+        """Stream the list of Products as a chunked JSON list"""
+        self._create_products(3)
+        resp = self.app.get(BASE_URL, query_string="stream=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 3)
+        resp = self.app.get(BASE_URL, query_string="stream=1&name=nothing")
+        self.assertEqual(resp.get_json(), [])
+
+    def test_query_multiple_filters(self):
+        """ Query Products by Category and Availability together """
+        products = self._create_products(10)
+        test_category = products[0].category
+        matches = [
+            product for product in products
+            if product.category == test_category and product.available
+        ]
+        resp = self.app.get(
+            BASE_URL, query_string="category={}&available=true".format(test_category)
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), len(matches))
+        for product in data:
+            self.assertEqual(product["category"], test_category)
+            self.assertEqual(product["available"], True)
+
+    def test_query_bad_availability(self):
+        """ Query Products with an invalid availability """
+        resp = self.app.get(BASE_URL, query_string="available=maybe")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_product_cached(self):
+        """Get a Product again after it was updated"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, test_product.id)
+        self.assertEqual(self.app.get(url).get_json()["name"], test_product.name)
+        data = self.app.get(url).get_json()
+        data["name"] = "renamed"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()["name"], "renamed")
+        resp = self.app.get("/internal/cache")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertGreater(resp.get_json()["hits"], 0)
+
+    def test_get_product_cached_as_stored(self):
+        """Cache the values of a write as they were stored"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, test_product.id)
+        data = dict(self.app.get(url).get_json(), price=20)
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.get_json()["price"], 20.0)
+        item = dict(ProductFactory().serialize(), price="12.50")
+        resp = self.app.post(BASE_URL + ":batch", json=[item], content_type=CONTENT_TYPE_JSON)
+        product_id = resp.get_json()["products"][0]["id"]
+        resp = self.app.get("{}/{}".format(BASE_URL, product_id))
+        self.assertEqual(resp.get_json()["price"], 12.5)
+
+    def test_get_product_not_modified(self):
+        """Get a Product with a current ETag"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, test_product.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        resp = self.app.get(url, headers={"If-None-Match": '"stale"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_get_product_list_not_modified(self):
+        """Get a list of Products with a current ETag"""
+        self._create_products(3)
+        resp = self.app.get(BASE_URL)
+        etag = resp.headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self._create_products(1)
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 4)
+
+    def test_get_product_list_fields(self):
+        """Get a list of Products with only some fields"""
+        self._create_products(5)
+        resp = self.app.get(BASE_URL, query_string="fields=price,id")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 5)
+        for product in data:
+            self.assertEqual(sorted(product.keys()), ["id", "price"])
+        resp = self.app.get(BASE_URL, query_string="fields=name&limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(resp.get_json()[0].keys()), ["name"])
+        self.assertIn("Link", resp.headers)
+        resp = self.app.get(
+            BASE_URL, query_string="fields=name", headers={"Accept": "application/x-ndjson"}
+        )
+        line = resp.get_data(as_text=True).splitlines()[0]
+        self.assertEqual(list(json.loads(line).keys()), ["name"])
+
+    def test_get_product_list_bad_fields(self):
+        """Get a list of Products with an unknown field"""
+        resp = self.app.get(BASE_URL, query_string="fields=id,secret")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_connection_pool_stats(self):
+        """Get the connection pool statistics"""
+        resp = self.app.get("/internal/pool")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("pool", resp.get_json())
+
+    def test_server_timing(self):
+        """Report the SQL statements and time of a request"""
+        self._create_products(3)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timing = resp.headers["Server-Timing"]
+        self.assertIn('desc="1 queries"', timing)
+        self.assertIn("serialize;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    def test_metrics(self):
+        """Expose the route metrics for Prometheus"""
+        self._create_products(1)
+        self.app.get(BASE_URL)
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        body = resp.get_data(as_text=True)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/products"}', body)
+        self.assertIn('http_requests_total{method="POST",route="/products",status="201"}', body)
+        self.assertIn("db_statements_total", body)
+        self.assertIn("product_cache_hits", body)
+
+    def test_query_budget_exceeded(self):
+        """Fail a request that issues more queries than its budget"""
+        test_product = self._create_products(1)[0]
+        product_cache.clear()
+        view = app.view_functions["get_products"]
+        with patch.object(view, "query_budget", 0):
+            self.assertRaises(
+                QueryBudgetExceeded, self.app.get, "{}/{}".format(BASE_URL, test_product.id)
+            )
+
     def test_get_product_not_found(self):
         """Get a Product thats not found"""
         resp = self.app.get("/products/0")
@@ -171,6 +466,89 @@ class TestProductServer(TestCase):
         updated_product = resp.get_json()
         self.assertEqual(updated_product["category"], "unknown")
 
+    def test_update_product_write_behind(self):
+        """Queue updates and write them on the next flush"""
+        products = self._create_products(2)
+        write_behind.configure(app, Product.bulk_update, 500, 0)
+        app.config["WRITE_BEHIND_ENABLED"] = True
+        try:
+            for price in (11.5, 12.5):
+                data = dict(products[0].serialize(), id=products[0].id, price=price)
+                resp = self.app.put("{}/{}".format(BASE_URL, products[0].id), json=data)
+                self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+                self.assertEqual(resp.get_json()["status"], "queued")
+                self.assertIn("/internal/write-behind", resp.headers["Location"])
+            seq = resp.get_json()["seq"]
+            # invalid bodies are still rejected right away
+            resp = self.app.put("{}/{}".format(BASE_URL, products[1].id), json={"name": "x"})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+            resp = self.app.get("/internal/write-behind")
+            self.assertEqual(resp.get_json()["pending"], 1)
+            self.assertGreaterEqual(resp.get_json()["coalesced"], 1)
+
+            resp = self.app.post("/internal/write-behind:flush")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertEqual(data["written"], 1)
+            self.assertEqual(data["flushed_seq"], seq)
+            resp = self.app.get("{}/{}".format(BASE_URL, products[0].id))
+            self.assertEqual(resp.get_json()["price"], 12.5)
+        finally:
+            app.config["WRITE_BEHIND_ENABLED"] = False
+            write_behind.flush()
+
+    def test_update_product_if_match(self):
+        """Update a Product only if it has not changed"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, test_product.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        data = resp.get_json()
+        data["name"] = "first " + data["name"]
+        resp = self.app.put(
+            url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        first = data["name"]
+        data["name"] = "second"
+        resp = self.app.put(
+            url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(url).get_json()["name"], first)
+        # a compressed response carries the ETag as a weak one
+        etag = self.app.get(url).headers["ETag"]
+        data["name"] = "third"
+        resp = self.app.put(
+            url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": "W/" + etag}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_update_product_if_match_race(self):
+        """Reject an If-Match update when the Product changes after the check"""
+        test_product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, test_product.id)
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        data = dict(resp.get_json(), name="mine")
+        find = Product.find
+
+        def find_then_change(product_id):
+            # another request commits its update right after the check reads
+            product = find(product_id)
+            with db.engine.begin() as conn:
+                conn.execute(Product.__table__.update().values(name="theirs"))
+            return product
+
+        with patch.object(Product, "find", side_effect=find_then_change):
+            resp = self.app.put(
+                url, json=data, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag}
+            )
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        # the other write bypassed the cache, so check the stored row
+        self.assertEqual(Product.find(test_product.id).name, "theirs")
+
     def test_update_product_not_exist(self):
         """Update a non-existant Product"""
         # update random product
@@ -204,6 +582,128 @@ class TestProductServer(TestCase):
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
 
+    def test_create_products_batch(self):
+        """Create a batch of Products"""
+        items = [ProductFactory().serialize() for _ in range(3)]
+        items.append({"name": "Pants"})
+        resp = self.app.post(
+            BASE_URL + ":batch", json=items, content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(len(data["products"]), 3)
+        self.assertEqual(data["errors"][0]["index"], 3)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_products_batches_within_budget(self):
+        """Write batches of several chunks within their query budgets"""
+        items = [dict(ProductFactory().serialize(), sku="SKU-{}".format(index)) for index in range(600)]
+        resp = self.app.post(BASE_URL + ":batch", json=items[:5], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.post(BASE_URL + ":batch", json=items[5:], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        products = resp.get_json()["products"]
+        resp = self.app.put(BASE_URL + ":batch", json=products, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put(BASE_URL + ":upsert", json=items, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["updated"], 600)
+
+    def test_create_products_batch_invalid(self):
+        """Create a batch of Products that are all invalid"""
+        resp = self.app.post(
+            BASE_URL + ":batch", json=[{}], content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(
+            BASE_URL + ":batch", json={}, content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_products_batch(self):
+        """Update a batch of Products"""
+        products = self._create_products(3)
+        items = [product.serialize() for product in products]
+        for item in items:
+            item["category"] = "unknown"
+        resp = self.app.put(
+            BASE_URL + ":batch", json=items, content_type=CONTENT_TYPE_JSON
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["products"]), 3)
+        resp = self.app.get(BASE_URL, query_string="category=unknown")
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_delete_products_by_filter(self):
+        """Delete the Products in a category"""
+        products = self._create_products(10)
+        test_category = products[0].category
+        others = [product for product in products if product.category != test_category]
+        resp = self.app.delete(BASE_URL, query_string="category={}".format(test_category))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(len(resp.get_json()), len(others))
+        resp = self.app.delete(BASE_URL, query_string="all=true")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_URL)
+        self.assertEqual(resp.get_json(), [])
+
+    def test_delete_products_unfiltered(self):
+        """Reject deletes that would remove every Product by mistake"""
+        self._create_products(3)
+        for query_string in ["", "categroy=Office", "all=false"]:
+            resp = self.app.delete(BASE_URL, query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 3)
+
+    def test_product_changes(self):
+        """Sync the changes since a checkpoint"""
+        products = self._create_products(3)
+        resp = self.app.get(BASE_URL + "/changes", query_string="limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data["changes"]), 2)
+        self.assertIn("cursor=", resp.headers["Link"])
+        resp = self.app.get(BASE_URL + "/changes")
+        checkpoint = resp.get_json()["checkpoint"]
+        self.assertNotIn("Link", resp.headers)
+
+        resp = self.app.delete("{}/{}".format(BASE_URL, products[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        action = "disable" if products[1].available else "enable"
+        resp = self.app.put("{}/{}/{}".format(BASE_URL, products[1].id, action))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL + "/changes", query_string="since={}".format(checkpoint))
+        changes = resp.get_json()["changes"]
+        self.assertEqual([change["id"] for change in changes], [products[0].id, products[1].id])
+        self.assertTrue(changes[0]["deleted"])
+        self.assertEqual(changes[1]["product"]["available"], not products[1].available)
+        resp = self.app.get(BASE_URL + "/changes", query_string="since=-1")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_events(self):
+        """Stream availability changes as Server-Sent Events"""
+        test_product = self._create_products(1)[0]
+        app.config["EVENTS_HEARTBEAT"] = 0.01
+        resp = self.app.get(BASE_URL + "/events", query_string="types=enable,disable")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        chunks = iter(resp.response)
+        try:
+            self.assertTrue(next(chunks).startswith(b"retry: "))
+            self.assertEqual(next(chunks), b": keep-alive\n\n")
+            action = "disable" if test_product.available else "enable"
+            self.app.put("{}/{}/{}".format(BASE_URL, test_product.id, action))
+            event = next(chunks).decode("utf8").split("\n")
+            self.assertEqual(event[1], "event: " + action)
+            self.assertEqual(json.loads(event[2][len("data: "):])["id"], test_product.id)
+        finally:
+            resp.close()
+            app.config["EVENTS_HEARTBEAT"] = 15
+        resp = self.app.get(BASE_URL + "/events", query_string="types=flip")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_disable_product(self):
         """Disable an existing product"""
         # create a product to disable
@@ -225,6 +725,97 @@ class TestProductServer(TestCase):
         logging.debug(updated_product)
         self.assertEqual(updated_product["available"], False)
 
+    def test_upsert_product_by_sku(self):
+        """Create then update a Product through its sku"""
+        data = ProductFactory().serialize()
+        del data["id"]
+        url = BASE_URL + "/sku/ERP-1"
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        created = resp.get_json()
+        self.assertEqual(created["sku"], "ERP-1")
+        self.assertIn("/products/{}".format(created["id"]), resp.headers["Location"])
+        # retrying is harmless and a change updates the same Product
+        resp = self.app.put(url, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.put(url, json=dict(data, price=12.5), content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), dict(created, price=12.5))
+        self.assertEqual(len(self.app.get(BASE_URL).get_json()), 1)
+        resp = self.app.put(url, json={"name": "x"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_upsert_products_batch(self):
+        """Create and update a list of Products by sku"""
+        items = []
+        for index in range(4):
+            data = ProductFactory().serialize()
+            del data["id"]
+            items.append(dict(data, sku="ERP-{}".format(index)))
+        resp = self.app.put(BASE_URL + ":upsert", json=items[:2], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["created"], 2)
+        batch = items + [dict(items[0], name="last wins"), {"name": "no sku"}]
+        resp = self.app.put(BASE_URL + ":upsert", json=batch, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual((data["created"], data["updated"]), (2, 2))
+        self.assertEqual([error["index"] for error in data["errors"]], [5])
+        resp = self.app.get(BASE_URL, query_string="fields=sku,name&sort=id")
+        self.assertEqual(len(resp.get_json()), 4)
+        self.assertIn({"sku": "ERP-0", "name": "last wins"}, resp.get_json())
+
+    def test_create_product_duplicate_sku(self):
+        """Reject a second Product with the same sku"""
+        data = ProductFactory().serialize()
+        data["sku"] = "ERP-1"
+        resp = self.app.post(BASE_URL, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.app.post(BASE_URL, json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(resp.get_json()["error"], "Conflict")
+
+    def test_disable_product_without_body(self):
+        """Disable and enable a Product without sending it"""
+        product = self._create_products(1)[0]
+        url = "{}/{}".format(BASE_URL, product.id)
+        for action, available in [("disable", False), ("disable", False), ("enable", True)]:
+            resp = self.app.put(url + "/" + action)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["available"], available)
+            self.assertEqual(resp.get_json()["name"], product.name)
+            self.assertEqual(self.app.get(url).get_json()["available"], available)
+
+    def test_set_available_batch(self):
+        """Disable and enable many Products by id or filter"""
+        products = self._create_products(6)
+        ids = [product.id for product in products[:3]]
+        resp = self.app.put(BASE_URL + ":enable", json={"ids": ids}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["updated"], len([p for p in products[:3] if not p.available]))
+        resp = self.app.get(BASE_URL, query_string="available=true")
+        self.assertTrue(set(ids) <= {product["id"] for product in resp.get_json()})
+        category = products[0].category
+        resp = self.app.put(BASE_URL + ":disable", query_string="category=" + category)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL, query_string="category={}&available=true".format(category))
+        self.assertEqual(resp.get_json(), [])
+        self.assertEqual(self.app.get("{}/{}".format(BASE_URL, products[0].id)).get_json()["available"], False)
+        for query_string in ["", "categroy=" + category]:
+            resp = self.app.put(BASE_URL + ":disable", query_string=query_string)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query_string)
+        resp = self.app.put(BASE_URL + ":disable", query_string="all=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(BASE_URL, query_string="available=true").get_json(), [])
+
+    def test_set_available_batch_bad_body(self):
+        """Reject availability batches without a list of ids"""
+        for body in [[1, 2], {"ids": "1"}, {"ids": [1, "2"]}]:
+            resp = self.app.put(BASE_URL + ":disable", json=body, content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.put(BASE_URL + ":disable", data="ids=1", content_type="text/plain")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
     def test_disable_product_not_found(self):
         """Disable a non-existent product"""
         # create a product to update
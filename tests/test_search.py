@@ -0,0 +1,53 @@
+"""
+Test cases for the in-process search index
+
+"""
+import unittest
+from service.search import SearchIndex, tokenize, score
+
+
+class TestSearchIndex(unittest.TestCase):
+    """ Test Cases for SearchIndex """
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.load([(1, "Blue Shirt"), (2, "Red Shirt"), (3, "Bluetooth Speaker")])
+
+    def test_tokenize(self):
+        """Split names into lower case words"""
+        self.assertEqual(tokenize("Blue-Shirt, XL"), ["blue", "shirt", "xl"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_score(self):
+        """Rank exact words above prefixes"""
+        self.assertEqual(score("Blue Shirt", ["blue"], "blue"), 3)
+        self.assertEqual(score("Shirt Blue", ["blue"], "blue"), 2)
+        self.assertEqual(score("Bluetooth", ["blue"], "blue"), 2)
+        self.assertEqual(score("Red Bluetooth", ["blue"], "blue"), 1)
+
+    def test_search(self):
+        """Match every word as a prefix"""
+        self.assertEqual(self.index.search("blue"), [(3, 1), (2, 3)])
+        self.assertEqual(self.index.search("SHIRT"), [(2, 1), (2, 2)])
+        self.assertEqual(self.index.search("blu shi"), [(2, 1)])
+        self.assertEqual(self.index.search("green"), [])
+        self.assertEqual(self.index.search(""), [])
+
+    def test_changes(self):
+        """Add, rename and remove Products"""
+        self.index.add(4, "Green Shirt")
+        self.assertEqual([match[1] for match in self.index.search("gr")], [4])
+        self.index.on_product_change("update", {"id": 4, "name": "Lamp"})
+        self.assertEqual(self.index.search("gr"), [])
+        self.index.on_product_change("delete", {"id": 1, "name": "Blue Shirt"})
+        self.assertEqual([match[1] for match in self.index.search("shirt")], [2])
+        self.assertNotIn("blue", self.index.words)
+        self.index.on_product_change("reset", None)
+        self.assertFalse(self.index.loaded)
+        self.assertEqual(self.index.search("red"), [])
+
+    def test_not_loaded(self):
+        """Ignore changes until the index is loaded"""
+        index = SearchIndex()
+        index.add(1, "Lamp")
+        self.assertEqual(index.names, {})
@@ -0,0 +1,76 @@
+"""
+Test cases for the write-behind queue
+
+"""
+import unittest
+from service.write_behind import WriteBehindQueue
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+    """ Test Cases for WriteBehindQueue """
+
+    def setUp(self):
+        self.batches = []
+        self.queue = WriteBehindQueue(self.save, max_items=3, max_delay=0)
+
+    def save(self, items):
+        """Flush function that records each batch"""
+        self.batches.append(items)
+        saved = [item for item in items if item.get("price") is not None]
+        errors = [
+            {"index": index, "error": "missing price"}
+            for index, item in enumerate(items)
+            if item.get("price") is None
+        ]
+        return saved, errors
+
+    def test_coalesce(self):
+        """Keep only the last update of each Product"""
+        self.assertEqual(self.queue.submit(1, {"price": 1.0}), 1)
+        self.queue.submit(2, {"price": 2.0})
+        self.assertEqual(self.queue.submit(1, {"price": 3.0}), 3)
+        self.assertEqual(self.queue.flush(), 2)
+        self.assertEqual(self.batches, [[{"price": 3.0, "id": 1}, {"price": 2.0, "id": 2}]])
+        status = self.queue.status()
+        self.assertEqual(status["accepted"], 3)
+        self.assertEqual(status["coalesced"], 1)
+        self.assertEqual(status["flushed_seq"], 3)
+        self.assertEqual(status["pending"], 0)
+        self.assertEqual(self.queue.flush(), 0)
+
+    def test_size_trigger(self):
+        """Flush as soon as max_items Products are queued"""
+        for product_id in range(1, 4):
+            self.queue.submit(product_id, {"price": 1.0})
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(self.queue.status()["batches"], 1)
+
+    def test_errors(self):
+        """Report the updates that could not be written"""
+        self.queue.submit(1, {"price": None})
+        self.queue.submit(2, {"price": 1.0})
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual(self.queue.status()["errors"], [{"seq": 1, "id": 1, "error": "missing price"}])
+
+    def test_failed_flush(self):
+        """Report every update of a batch that raised"""
+
+        def fail(items):
+            raise RuntimeError("database is gone")
+
+        queue = WriteBehindQueue(fail, max_items=10, max_delay=0)
+        queue.submit(1, {"price": 1.0})
+        self.assertEqual(queue.flush(), 0)
+        status = queue.status()
+        self.assertEqual(status["flushed_seq"], 1)
+        self.assertEqual(status["errors"][0]["error"], "database is gone")
+
+    def test_due(self):
+        """Flush the oldest update after max_delay"""
+        now = [0.0]
+        queue = WriteBehindQueue(self.save, max_items=10, max_delay=1.0, clock=lambda: now[0])
+        queue.pending[1] = (1, {"id": 1})
+        queue.oldest = 0.0
+        self.assertFalse(queue._due())  # pylint: disable=protected-access
+        now[0] = 1.5
+        self.assertTrue(queue._due())  # pylint: disable=protected-access